@@ -35,6 +35,8 @@ from GRATools import GRATOOLS_OUT, GRATOOLS_CONFIG
 from GRATools.utils.logging_ import logger, startmsg
 from GRATools.utils.matplotlib_ import pyplot as plt
 from GRATools.utils.matplotlib_ import overlay_tag, save_current_figure
+from GRATools.utils.gPartialMap import PartialSkyMap
+from GRATools.utils.gMaskCache import get_mask
 
 GRATOOLS_OUT_FLUX = os.path.join(GRATOOLS_OUT, 'output_flux')
 
@@ -84,7 +86,7 @@ def mkCl(**kwargs):
     out_label = data.OUT_LABEL
     binning_label = data.BINNING_LABEL
     mask_file = data.MASK_FILE
-    mask = hp.read_map(mask_file)
+    mask = get_mask(mask_file)
     cl_param_file = os.path.join(GRATOOLS_OUT, '%s_%s_parameters.txt' \
                                      %(in_label, binning_label))
     from GRATools.utils.gFTools import get_cl_param
@@ -101,21 +103,22 @@ def mkCl(**kwargs):
         _l = np.arange(l_max)
         wb_en = wb.hslice(eweightedmean)(_l)
         flux_map_name = in_label+'_flux_%i-%i.fits'%(emin, emax)
-        flux_map = hp.read_map(os.path.join(GRATOOLS_OUT_FLUX, flux_map_name))
-        flux_map_masked = hp.ma(flux_map)
-        flux_map_masked.mask = np.logical_not(mask)
-        fsky = 1.-(len(np.where(flux_map_masked.filled() == hp.UNSEEN)[0])/\
-                       float(len(flux_map)))
+        flux_map = PartialSkyMap.read(os.path.join(GRATOOLS_OUT_FLUX,
+                                                   flux_map_name))
+        flux_map = flux_map.restrict(mask.unmask)
+        fsky = flux_map.fsky()
+        # anafast needs the full-sky map (hp.UNSEEN outside the pixels)
+        flux_map_filled = flux_map.to_map()
         if kwargs['show'] == True:
-            hp.mollview(flux_map_masked.filled(), title='f$_{sky}$ = %.3f'%fsky,
+            hp.mollview(flux_map_filled, title='f$_{sky}$ = %.3f'%fsky,
                         min=1e-7, max=1e-4, norm='log')
             plt.show()
         print 'fsky = ', fsky
-        nside = hp.npix2nside(len(flux_map))
+        nside = flux_map.nside
         wpix = hp.sphtfunc.pixwin(nside)[:l_max]
-        _cl = hp.sphtfunc.anafast(flux_map_masked.filled(), lmax=l_max-1, \
+        _cl = hp.sphtfunc.anafast(flux_map_filled, lmax=l_max-1, \
                                       iter=5)
-        _cl_fit = hp.sphtfunc.anafast(flux_map_masked.filled(), iter=4)
+        _cl_fit = hp.sphtfunc.anafast(flux_map_filled, iter=4)
         cn_fit = np.average(_cl_fit[-500:-100]/fsky)/len(_cl_fit[-500:-100])
         print 'cn fit = ', cn_fit
         print 'cn poisson = ', _cn[i]
@@ -35,6 +35,7 @@ from GRATools import GRATOOLS_OUT, GRATOOLS_CONFIG
 from GRATools.utils.logging_ import logger, startmsg
 from GRATools.utils.matplotlib_ import pyplot as plt
 from GRATools.utils.matplotlib_ import overlay_tag, save_current_figure
+from GRATools.utils.gMaskCache import get_mask
 
 GRATOOLS_OUT_FLUX = os.path.join(GRATOOLS_OUT, 'output_flux')
 
@@ -83,7 +84,7 @@ def mkCross(**kwargs):
     out_label = data.OUT_LABEL
     binning_label = data.BINNING_LABEL
     mask_file = data.MASK_FILE
-    mask = hp.read_map(mask_file)
+    mask = get_mask(mask_file)
     cl_param_file1 = os.path.join(GRATOOLS_OUT, '%s_%s_parameters.txt' \
                                      %(in_label1, binning_label))
     cl_param_file2 = os.path.join(GRATOOLS_OUT, '%s_%s_parameters.txt' \
@@ -107,9 +108,9 @@ def mkCross(**kwargs):
         flux_map1 = hp.read_map(os.path.join(GRATOOLS_OUT_FLUX, flux_map_name1))
         flux_map2 = hp.read_map(os.path.join(GRATOOLS_OUT_FLUX, flux_map_name2))
         flux_map_masked1 = hp.ma(flux_map1)
-        flux_map_masked1.mask = np.logical_not(mask)
+        flux_map_masked1.mask = mask.ma_mask()
         flux_map_masked2 = hp.ma(flux_map2)
-        flux_map_masked2.mask = np.logical_not(mask)
+        flux_map_masked2.mask = mask.ma_mask()
         fsky1 = 1.-(len(np.where(flux_map_masked1.filled() == hp.UNSEEN)[0])/\
                        float(len(flux_map1)))
         fsky2 = 1.-(len(np.where(flux_map_masked2.filled() == hp.UNSEEN)[0])/\
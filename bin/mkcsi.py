@@ -18,6 +18,7 @@
 import os
 import imp
 import ast
+import time
 import argparse
 import numpy as np
 import healpy as hp
@@ -33,10 +34,18 @@ __description__ = 'Makes the analysis'
 
 
 from GRATools import GRATOOLS_OUT, GRATOOLS_CONFIG
-from GRATools.utils.logging_ import logger, startmsg
+from GRATools.utils.logging_ import logger, abort, startmsg
 from GRATools.utils.matplotlib_ import pyplot as plt
 from GRATools.utils.matplotlib_ import overlay_tag, save_current_figure
 from GRATools.utils.gWindowFunc import get_psf_ref
+from GRATools.utils.gCsi import pix2xyz, build_pair_tree, get_pairs
+from GRATools.utils.gCsi import csi_block_sums, csi_harmonic
+from GRATools.utils.gCsi import permute_ensemble, null_block_sums
+from GRATools.utils.gCsi import get_pair_index_dir, write_pair_index
+from GRATools.utils.gCsi import load_pair_index, get_index_pairs
+from GRATools.utils.gCsi import share_array, attach_array
+from GRATools.utils.gCsi import get_jk_regions, region_block_sums
+from GRATools.utils.gCsi import jackknife_csi
 
 GRATOOLS_OUT_FLUX = os.path.join(GRATOOLS_OUT, 'output_flux')
 
@@ -48,6 +57,31 @@ PARSER.add_argument('--config', type=str, required=True,
 PARSER.add_argument('--ncores', type=int, required=False,
                     default=6,
                     help='Number of cores to be used in the process')
+PARSER.add_argument('--chunk-size', type=int, required=False,
+                    default=1000,
+                    help='Number of pixels processed in each task of the pool')
+PARSER.add_argument('--paircache', type=ast.literal_eval,
+                    choices=[True, False], default=False,
+                    help='store/reuse the pairs of the tree method on disk')
+PARSER.add_argument('--resume', type=ast.literal_eval,
+                    choices=[True, False], default=False,
+                    help='resume an interrupted run from its state file')
+PARSER.add_argument('--nperm', type=int, required=False,
+                    default=0,
+                    help='Number of permutations of the unmasked pixels '
+                    'used to build the null distribution of Csi')
+PARSER.add_argument('--ebatch', type=ast.literal_eval,
+                    choices=[True, False], default=False,
+                    help='process together the energy bins with the same '
+                    'NSIDE and mask, computing also their cross Csi')
+PARSER.add_argument('--jackknife', type=int, required=False,
+                    default=0,
+                    help='NSIDE of the superpixels used as jackknife regions '
+                    'to get the Csi covariance (0 = no jackknife)')
+PARSER.add_argument('--method', type=str, choices=['tree', 'disc', 'harmonic'],
+                    default='tree',
+                    help='pair counting (KD-tree or per-pixel query_disc) '
+                    'or Legendre transform of the pseudo-Cl')
 
 def get_var_from_file(filename):
     f = open(filename)
@@ -55,18 +89,74 @@ def get_var_from_file(filename):
     data = imp.load_source('data', '', f)
     f.close()
 
-def permute_unmasked_pix(_arr):
-    unfrozen_indices = [i for i, val in enumerate(_arr) if val>hp.UNSEEN]
+CHECKPOINT_INTERVAL = 300 #[s]
+
+def load_csi_state(state_file):
+    """Returns the content of the state file of a Csi run as a dictionary.
+    """
+    logger.info('Resuming from %s...'%state_file)
+    f = np.load(state_file)
+    state = dict((key, f[key]) for key in f.files)
+    f.close()
+    return state
+
+def save_csi_state(state_file, state):
+    """Saves the state of a Csi run (overwriting the file only once the new
+       one is complete).
+    """
+    tmp_file = state_file.replace('.npz', '_tmp.npz')
+    np.savez(tmp_file, **state)
+    os.rename(tmp_file, state_file)
+
+def permute_unmasked_pix(_arr, seed=None):
+    unfrozen_indices = np.where(_arr > hp.UNSEEN)[0]
     unfrozen_set = _arr[unfrozen_indices]
-    unfrozen_set_p = np.random.permutation(unfrozen_set)
+    unfrozen_set_p = np.random.RandomState(seed).permutation(unfrozen_set)
     _arr[unfrozen_indices] = unfrozen_set_p
     return _arr
 
-def csi_compute(param):
+CSI_WORKER = {}
+
+def init_csi_worker(shared, nside, th_bins, method, index_dir=None,
+                    cross=False):
+    """Attaches each worker of the pool to the read-only shared-memory
+       buffers of the maps (once per worker, not once per task). If a pair
+       index is given, it is memory-mapped instead of building the KD-tree.
+    """
+    for key in shared:
+        CSI_WORKER[key] = attach_array(shared[key])
+    if 'reg' in CSI_WORKER:
+        CSI_WORKER['nreg'] = int(np.max(CSI_WORKER['reg'])) + 1
+    CSI_WORKER['nside'] = nside
+    CSI_WORKER['th_bins'] = th_bins
+    CSI_WORKER['method'] = method
+    CSI_WORKER['cross'] = cross
+    if index_dir is not None:
+        CSI_WORKER['index'] = load_pair_index(index_dir)
+    elif method == 'tree':
+        CSI_WORKER['tree'] = build_pair_tree(CSI_WORKER['xyz'])
+
+def get_chunk_pairs(start, stop):
+    """Returns the pairs (i, j, bin) of the unmasked pixels from start to
+       stop, from the pair index if loaded, from the KD-tree otherwise.
+    """
+    if 'index' in CSI_WORKER:
+        return get_index_pairs(CSI_WORKER['index'], start, stop)
+    return get_pairs(CSI_WORKER['tree'], CSI_WORKER['xyz'],
+                     CSI_WORKER['th_bins'], start, stop)
+
+def csi_pairs_chunk(bounds):
+    """worker function: returns the pairs of a chunk, to build the index"""
+    i, j, _bin = get_chunk_pairs(*bounds)
+    return i, j.astype(np.int32), _bin.astype(np.int16)
+
+def csi_compute(i):
     """worker function"""
-    get_var_from_file(os.path.join(GRATOOLS_CONFIG, 'Csi_config.py'))
-    th_bins = data.TH_BINNING
-    i, veci, dI, R, nside = param
+    th_bins = CSI_WORKER['th_bins']
+    nside = CSI_WORKER['nside']
+    dI = CSI_WORKER['dI'][0]
+    R = CSI_WORKER['dR'][0]
+    veci = hp.pixelfunc.pix2vec(nside, i)
     if i%10000 == 0:
         print i
     dIi = dI[i]
@@ -90,6 +180,37 @@ def csi_compute(param):
         Rij_list[th].append(Rij)
     return dIij_list, counts_list, Rij_list
 
+def csi_compute_chunk(chunk):
+    """worker function: returns the chunk id, the array with the sums
+       over the pairs of the unmasked pixels from start to stop (see
+       csi_block_sums), followed by the sums of the null maps, if any, and
+       the sums per jackknife region (see region_block_sums), if any
+    """
+    k, start, stop = chunk
+    th_bins = CSI_WORKER['th_bins']
+    nbins = len(th_bins) - 1
+    pix = CSI_WORKER['pix']
+    if CSI_WORKER['method'] == 'tree':
+        i, j, _bin = get_chunk_pairs(start, stop)
+        sums = csi_block_sums(i, j, _bin, CSI_WORKER['dI'],
+                              CSI_WORKER['dR'], nbins, CSI_WORKER['cross'])
+        if 'null' in CSI_WORKER:
+            sums = np.vstack((sums, null_block_sums(i, j, _bin,
+                                                    CSI_WORKER['null'],
+                                                    nbins,
+                                                    CSI_WORKER.get('null2'))))
+        jk_sums = None
+        if 'reg' in CSI_WORKER:
+            jk_sums = region_block_sums(i, j, _bin,
+                                        CSI_WORKER['reg'], CSI_WORKER['nreg'],
+                                        CSI_WORKER['dI'], CSI_WORKER['dR'],
+                                        nbins, CSI_WORKER['cross'])
+        return k, sums, jk_sums
+    sums = np.zeros((3, nbins))
+    for i in pix[start:stop]:
+        sums += np.array(csi_compute(i)).reshape(3, nbins)
+    return k, sums, None
+
 def udgrade_as_psf(in_map, cont_ang):
     npix = len(in_map)
     in_nside = hp.pixelfunc.npix2nside(npix)
@@ -107,88 +228,340 @@ def udgrade_as_psf(in_map, cont_ang):
     logger.info('Udgraded map from NSIDE=%i to NSIDE=%i'%(in_nside, out_nside))
     return out_map
 
+def write_csi_rows(csi_txt, theta, csi, r, r_null=None, csi_cov=None):
+    """Writes the THETA, CSI and R rows of an energy bin, the mean and
+       covariance (flattened) of the null Csi curves, if any, and the
+       jackknife covariance (flattened) of Csi, if any.
+    """
+    csi_txt.write('THETA\t%s\n'%str(list(theta)).replace('[',''). \
+                      replace(']','').replace(', ', ' ')) 
+    csi_txt.write('CSI\t%s\n'%str(list(csi)).replace('[',''). \
+                      replace(']','').replace(', ', ' '))
+    csi_txt.write('R\t%s\n'%str(list(r)).replace('[',''). \
+                      replace(']','').replace(', ', ' '))
+    if r_null is not None and len(r_null) > 1:
+        r_mean = np.mean(r_null, axis=0)
+        r_cov = np.cov(r_null, rowvar=False)
+        csi_txt.write('R_MEAN\t%s\n'%str(list(r_mean)).replace('[',''). \
+                          replace(']','').replace(', ', ' '))
+        csi_txt.write('R_COV\t%s\n'%str(list(r_cov.ravel())). \
+                          replace('[','').replace(']','').replace(', ', ' '))
+    if csi_cov is not None:
+        csi_txt.write('CSI_COV\t%s\n'%str(list(csi_cov.ravel())). \
+                          replace('[','').replace(']','').replace(', ', ' '))
+
+def read_csi_maps(flux_map_file, cont_ang, Imean, seed, nside=None):
+    """Returns the fluctuation map, its shuffled copy, NSIDE and the
+       unmasked pixels of an energy bin. The map is degraded according to
+       the PSF, or to the given NSIDE.
+    """
+    flux_map = hp.read_map(flux_map_file)
+    if nside is None:
+        flux_map = udgrade_as_psf(flux_map, cont_ang)
+    else:
+        flux_map = hp.pixelfunc.ud_grade(flux_map, nside)
+    R = np.copy(flux_map)
+    fsky = 1.-(len(np.where(flux_map == hp.UNSEEN)[0])/\
+                   float(len(flux_map)))
+    logger.info('fsky = %f'%fsky)
+    npix = len(flux_map)
+    nside = hp.npix2nside(npix)        
+    _unmask = np.where(flux_map != hp.UNSEEN)[0]
+    dI = flux_map - Imean
+    dR = R - Imean
+    dR = permute_unmasked_pix(dR, seed)
+    return dI, dR, nside, _unmask
+
 def mkCsi(**kwargs):
     """                                      
     """
     get_var_from_file(kwargs['config'])
     ncores = kwargs['ncores']
+    method = kwargs['method']
+    nperm = kwargs['nperm']
+    ebatch = kwargs['ebatch']
+    jackknife = kwargs['jackknife']
+    chunk_size = kwargs['chunk_size']
     psf_file = data.PSF_REF_FILE
-    p = multiprocessing.Pool(processes=ncores)
     logger.info('Starting Csi analysis...')
     in_label = data.IN_LABEL
+    in_label2 = getattr(data, 'IN_LABEL2', None)
     out_label = data.OUT_LABEL
     binning_label = data.BINNING_LABEL
     cl_param_file = os.path.join(GRATOOLS_OUT, '%s_%s_parameters.txt' \
                                      %(in_label, binning_label))
     from GRATools.utils.gFTools import get_cl_param
     _emin, _emax, _emean, _f, _ferr, _cn, _fsky = get_cl_param(cl_param_file)
-    csi_txt = open(os.path.join(GRATOOLS_OUT, '%s_%s_csi.txt' \
-                                   %(out_label, binning_label)), 'w')
+    if in_label2 is not None:
+        logger.info('Cross-correlating %s with %s...'%(in_label, in_label2))
+        cl_param_file2 = os.path.join(GRATOOLS_OUT, '%s_%s_parameters.txt' \
+                                          %(in_label2, binning_label))
+        _emin2, _emax2, _emean2, _f2, _ferr2, _cn2, _fsky2 = \
+            get_cl_param(cl_param_file2)
+    state_file = os.path.join(GRATOOLS_OUT, '%s_%s_csi_state.npz' \
+                                  %(out_label, binning_label))
+    if kwargs['resume'] == True and os.path.exists(state_file):
+        state = load_csi_state(state_file)
+        if str(state['method']) != method:
+            abort('State file created with --method %s'%state['method'])
+        chunk_size = int(state['chunk_size'])
+        nperm = int(state['nperm'])
+        ebatch = bool(state['ebatch'])
+        jackknife = int(state['jackknife'])
+    else:
+        state = {'method': method, 'chunk_size': chunk_size, 'nperm': nperm,
+                 'ebatch': ebatch, 'jackknife': jackknife}
+    if nperm > 0 and method == 'disc':
+        abort('--nperm is not available with --method disc')
+    if ebatch == True and method == 'disc':
+        abort('--ebatch is not available with --method disc')
+    if in_label2 is not None and method == 'disc':
+        abort('IN_LABEL2 is not available with --method disc')
+    if in_label2 is not None and ebatch == True:
+        abort('--ebatch is not available with IN_LABEL2')
+    if jackknife > 0 and method != 'tree':
+        abort('--jackknife is only available with --method tree')
     psf_ref = get_psf_ref(psf_file)
     #psf_ref.plot(show=False)
     #plt.xscale('log')
     #plt.yscale('log')
     #plt.show()
-    for i, (emin, emax) in enumerate(zip(_emin, _emax)):
-        logger.info('Considering bin %.2f - %.2f ...'%(emin, emax))
+    th_bins = data.TH_BINNING
+    nbins = len(th_bins) - 1
+    theta = []
+    for thmin, thmax in zip(th_bins[:-1], th_bins[1:]):
+        th_mean = np.sqrt(thmin*thmax)
+        theta.append(th_mean)
+    theta = np.array(theta)
+    todo = []
+    for i in range(0, len(_emin)):
+        if 'bin%i_csi'%i in state:
+            logger.info('Bin %i already done...'%i)
+            continue
+        if 'bin%i_seed'%i not in state:
+            state['bin%i_seed'%i] = np.random.randint(0, 2**31 - 1)
+        todo.append(i)
+
+    def get_maps(i):
+        logger.info('Considering bin %.2f - %.2f ...'%(_emin[i], _emax[i]))
         cont_ang = np.radians(psf_ref(_emean[i]))
-        csi_txt.write('ENERGY\t %.2f %.2f %.2f\n'%(emin, emax, _emean[i]))
-        flux_map_name = in_label+'_flux_%i-%i.fits'%(emin, emax)
-        flux_map = hp.read_map(os.path.join(GRATOOLS_OUT_FLUX, flux_map_name))
-        flux_map = udgrade_as_psf(flux_map, cont_ang)
-        R = hp.read_map(os.path.join(GRATOOLS_OUT_FLUX, flux_map_name))
-        R = udgrade_as_psf(R, cont_ang)
-        fsky = 1.-(len(np.where(flux_map == hp.UNSEEN)[0])/\
-                       float(len(flux_map)))
-        logger.info('fsky = %f'%fsky)
-        npix = len(flux_map)
-        nside = hp.npix2nside(npix)        
-        _unmask = np.where(flux_map != hp.UNSEEN)[0]
+        flux_map_name = in_label+'_flux_%i-%i.fits'%(_emin[i], _emax[i])
+        return read_csi_maps(os.path.join(GRATOOLS_OUT_FLUX, flux_map_name),
+                             cont_ang, _f[i], int(state['bin%i_seed'%i]))
+
+    def get_cross_maps(i):
+        dI, dR, nside, _unmask = get_maps(i)
+        flux_map_name = in_label2+'_flux_%i-%i.fits'%(_emin[i], _emax[i])
+        dI2, dR2, nside, _unmask2 = \
+            read_csi_maps(os.path.join(GRATOOLS_OUT_FLUX, flux_map_name),
+                          None, _f2[i], int(state['bin%i_seed'%i]) + 2,
+                          nside)
+        _unmask = np.intersect1d(_unmask, _unmask2)
+        logger.info('fsky (common mask) = %f'\
+                        %(len(_unmask)/float(hp.nside2npix(nside))))
+        return np.array([dI, dI2]), np.array([dR, dR2]), nside, _unmask
+
+    maps = {}
+    if ebatch == True:
+        logger.info('Grouping the energy bins by NSIDE and mask...')
+        groups, geometry = [], []
+        for i in todo:
+            maps[i] = get_maps(i)
+            key = get_pair_index_dir(maps[i][2], th_bins, maps[i][3])
+            if key in geometry:
+                groups[geometry.index(key)].append(i)
+            else:
+                geometry.append(key)
+                groups.append([i])
+    else:
+        groups = [[i] for i in todo]
+    for group in groups:
+        logger.info('Computing Csi for the energy bins %s...'%str(group))
+        if in_label2 is not None:
+            dI, dR, nside, _unmask = get_cross_maps(group[0])
+        else:
+            for i in group:
+                if i not in maps:
+                    maps[i] = get_maps(i)
+            nside, _unmask = maps[group[0]][2], maps[group[0]][3]
+            dI = np.array([maps[i][0] for i in group])
+            dR = np.array([maps[i][1] for i in group])
+        npix = hp.nside2npix(nside)
         npix_unmask = len(_unmask)
-        Imean = _f[i]
-        dI = flux_map - Imean
-        dR = R - Imean
-        R = permute_unmasked_pix(R)
-        dR = permute_unmasked_pix(dR)
-        th_bins = data.TH_BINNING
-        theta = []
-        for thmin, thmax in zip(th_bins[:-1], th_bins[1:]):
-            th_mean = np.sqrt(thmin*thmax)
-            theta.append(th_mean)
-        theta = np.array(theta)
-        logger.info('Computing Csi...')
-        diri = hp.pixelfunc.pix2ang(nside, _unmask)
-        veci = hp.rotator.dir2vec(diri)
-        xyz = np.array([(veci[0][i], veci[1][i], veci[2][i]) 
-                        for i in range(0, len(veci[0]))])
-        args = zip(_unmask, xyz, [dI]*npix_unmask, [dR]*npix_unmask,
-                   [nside]*npix_unmask)
-        #args = zip(_unmask, xyz, [flux_map]*npix_unmask, [R]*npix_unmask, 
-        #           [nside]*npix_unmask)
-        a = np.array(p.map(csi_compute, args))
-        SUMij_list = a[:, 0]   
-        SUMf_list = a[:, 1]
-        SUMR_list = a[:, 2]
-        SUMij_th = []
-        SUMf_th = []
-        SUMR_th = []
-        for i, s in enumerate(SUMij_list[0]):
-            SUMij_th.append(np.sum(SUMij_list[:, i]))
-            SUMf_th.append(np.sum(SUMf_list[:, i]))
-            SUMR_th.append(np.sum(SUMR_list[:, i]))
-        csi = (np.array(SUMij_th))/np.array(SUMf_th)#-Imean**2
-        r = (np.array(SUMR_th))/np.array(SUMf_th)#-Imean**2
-        csi_txt.write('THETA\t%s\n'%str(list(theta)).replace('[',''). \
-                          replace(']','').replace(', ', ' ')) 
-        csi_txt.write('CSI\t%s\n'%str(list(csi)).replace('[',''). \
-                          replace(']','').replace(', ', ' '))
-        csi_txt.write('R\t%s\n'%str(list(r)).replace('[',''). \
-                          replace(']','').replace(', ', ' '))
+        nmaps = len(dI)
+        cross = [(e1, e2) for e1 in range(0, nmaps) \
+                     for e2 in range(e1 + 1, nmaps)]
+        ncross = len(cross)
+        null, null2 = np.zeros((0, npix_unmask)), None
+        if nperm > 0:
+            logger.info('Generating %i permutations of the maps...'%nperm)
+            if in_label2 is not None:
+                null = permute_ensemble(dI[0][_unmask], nperm,
+                                        int(state['bin%i_seed'%group[0]]) + 1)
+                null2 = dI[1][_unmask]
+            else:
+                null = np.vstack([permute_ensemble(dI[e][_unmask], nperm,
+                                                   int(state['bin%i_seed'%i])
+                                                   + 1)
+                                  for e, i in enumerate(group)])
+        nrows = 2*nmaps + 1 + 2*ncross + len(null)
+        if method == 'harmonic':
+            _mask = np.zeros(npix)
+            _mask[_unmask] = 1
+            # the harmonic estimates are already normalized (unit counts)
+            sums = np.zeros((nrows, nbins))
+            sums[nmaps] = 1.
+            for e in range(0, nmaps):
+                sums[e] = csi_harmonic(dI[e], _mask, th_bins)
+                sums[nmaps + 1 + e] = csi_harmonic(dR[e], _mask, th_bins)
+            for c, (e1, e2) in enumerate(cross):
+                sums[2*nmaps + 1 + c] = csi_harmonic(dI[e1], _mask, th_bins,
+                                                     dmap2=dI[e2])
+                sums[2*nmaps + 1 + ncross + c] = csi_harmonic(dR[e1], _mask,
+                                                              th_bins,
+                                                              dmap2=dR[e2])
+            dnull2 = None
+            if null2 is not None:
+                dnull2 = np.zeros(npix)
+                dnull2[_unmask] = null2
+            for k in range(0, len(null)):
+                dnull = np.zeros(npix)
+                dnull[_unmask] = null[k]
+                sums[2*nmaps + 1 + 2*ncross + k] = csi_harmonic(dnull, _mask,
+                                                                th_bins,
+                                                                dmap2=dnull2)
+        else:
+            if method == 'tree':
+                # the pair engine only needs the unmasked pixels
+                dI, dR = dI[:, _unmask], dR[:, _unmask]
+            shared = {'pix': share_array(_unmask), 'dI': share_array(dI),
+                      'dR': share_array(dR)}
+            if nperm > 0:
+                shared['null'] = share_array(null)
+            if null2 is not None:
+                shared['null2'] = share_array(null2)
+            if method == 'tree':
+                shared['xyz'] = share_array(pix2xyz(nside, _unmask))
+            if jackknife > 0:
+                reg, nreg = get_jk_regions(nside, _unmask, jackknife)
+                logger.info('%i jackknife regions (NSIDE=%i)'\
+                                %(nreg, jackknife))
+                shared['reg'] = share_array(reg)
+            chunks = [(start, min(start + chunk_size, npix_unmask)) for start
+                      in range(0, npix_unmask, chunk_size)]
+            gkey = 'group%s'%'-'.join([str(i) for i in group])
+            if '%s_done'%gkey not in state:
+                state['%s_done'%gkey] = np.zeros(len(chunks), dtype=bool)
+                state['%s_sums'%gkey] = np.zeros((nrows, nbins))
+                if jackknife > 0:
+                    state['%s_jk'%gkey] = np.zeros((nreg, nrows - len(null),
+                                                    nbins))
+            done = state['%s_done'%gkey]
+            sums = state['%s_sums'%gkey]
+            tasks = [(k, start, stop) for k, (start, stop) in \
+                         enumerate(chunks) if not done[k]]
+            logger.info('%i/%i chunks to compute'%(len(tasks), len(chunks)))
+            index_dir = None
+            if method == 'tree' and kwargs['paircache'] == True:
+                index_dir = get_pair_index_dir(nside, th_bins, _unmask)
+                if not os.path.exists(index_dir):
+                    logger.info('Building the pair index...')
+                    p = multiprocessing.Pool(processes=ncores,
+                                             initializer=init_csi_worker,
+                                             initargs=(shared, nside, th_bins,
+                                                       method))
+                    write_pair_index(p.imap(csi_pairs_chunk, chunks),
+                                     npix_unmask, index_dir)
+                    p.close()
+                    p.join()
+                else:
+                    logger.info('Using the pair index %s'%index_dir)
+            p = multiprocessing.Pool(processes=ncores,
+                                     initializer=init_csi_worker,
+                                     initargs=(shared, nside, th_bins, method,
+                                               index_dir, nmaps > 1))
+            last_save = time.time()
+            for k, s, s_jk in p.imap_unordered(csi_compute_chunk, tasks):
+                sums += s
+                if s_jk is not None:
+                    state['%s_jk'%gkey] += s_jk
+                done[k] = True
+                if time.time() - last_save > CHECKPOINT_INTERVAL:
+                    save_csi_state(state_file, state)
+                    last_save = time.time()
+                    logger.info('%i/%i chunks done'%(np.sum(done),
+                                                     len(chunks)))
+            p.close()
+            p.join()
+        SUMf_th = sums[nmaps]
+        r_null = sums[2*nmaps + 1 + 2*ncross:]/SUMf_th
+        if jackknife > 0:
+            logger.info('Computing the jackknife covariance...')
+            jk_sums = state['%s_jk'%gkey]
+            if in_label2 is not None:
+                csi_jk, state['bin%i_csicov'%group[0]] = \
+                    jackknife_csi(sums, jk_sums, 2*nmaps + 1, nmaps)
+            else:
+                for e, i in enumerate(group):
+                    csi_jk, state['bin%i_csicov'%i] = \
+                        jackknife_csi(sums, jk_sums, e, nmaps)
+                for c, (e1, e2) in enumerate(cross):
+                    ckey = 'cross%i-%i'%(group[e1], group[e2])
+                    csi_jk, state['%s_csicov'%ckey] = \
+                        jackknife_csi(sums, jk_sums, 2*nmaps + 1 + c, nmaps)
+        if in_label2 is not None:
+            i = group[0]
+            state['bin%i_theta'%i] = theta
+            state['bin%i_csi'%i] = sums[2*nmaps + 1]/SUMf_th
+            state['bin%i_r'%i] = sums[2*nmaps + 2]/SUMf_th
+            state['bin%i_rnull'%i] = r_null
+            save_csi_state(state_file, state)
+            continue
+        r_null = r_null.reshape((nmaps, nperm, nbins))
+        for e, i in enumerate(group):
+            state['bin%i_theta'%i] = theta
+            state['bin%i_csi'%i] = sums[e]/SUMf_th#-Imean**2
+            state['bin%i_r'%i] = sums[nmaps + 1 + e]/SUMf_th#-Imean**2
+            state['bin%i_rnull'%i] = r_null[e]
+            del maps[i]
+        for c, (e1, e2) in enumerate(cross):
+            ckey = 'cross%i-%i'%(group[e1], group[e2])
+            state['%s_csi'%ckey] = sums[2*nmaps + 1 + c]/SUMf_th
+            state['%s_r'%ckey] = sums[2*nmaps + 1 + ncross + c]/SUMf_th
+        save_csi_state(state_file, state)
+    csi_file = os.path.join(GRATOOLS_OUT, '%s_%s_csi.txt' \
+                                %(out_label, binning_label))
+    if in_label2 is not None:
+        csi_file = os.path.join(GRATOOLS_OUT, '%s_%s_csicross.txt' \
+                                    %(out_label, binning_label))
+    csi_txt = open(csi_file, 'w')
+    for i, (emin, emax) in enumerate(zip(_emin, _emax)):
+        csi_txt.write('ENERGY\t %.2f %.2f %.2f\n'%(emin, emax, _emean[i]))
+        write_csi_rows(csi_txt, state['bin%i_theta'%i], state['bin%i_csi'%i],
+                       state['bin%i_r'%i], state['bin%i_rnull'%i],
+                       state.get('bin%i_csicov'%i))
     csi_txt.close()
-    p.close()
-    p.join()
-    logger.info('Created %s'%(os.path.join(GRATOOLS_OUT, '%s_%s_csi.txt' \
-                                               %(out_label, binning_label))))
+    logger.info('Created %s'%csi_file)
+    if ebatch == True:
+        cross_txt = open(os.path.join(GRATOOLS_OUT, '%s_%s_csiEcross.txt' \
+                                          %(out_label, binning_label)), 'w')
+        for i1 in range(0, len(_emin)):
+            for i2 in range(i1 + 1, len(_emin)):
+                if 'cross%i-%i_csi'%(i1, i2) not in state:
+                    continue
+                cross_txt.write('ENERGY1\t %.2f %.2f %.2f\n'\
+                                    %(_emin[i1], _emax[i1], _emean[i1]))
+                cross_txt.write('ENERGY2\t %.2f %.2f %.2f\n'\
+                                    %(_emin[i2], _emax[i2], _emean[i2]))
+                write_csi_rows(cross_txt, theta,
+                               state['cross%i-%i_csi'%(i1, i2)],
+                               state['cross%i-%i_r'%(i1, i2)],
+                               state.get('cross%i-%i_rnull'%(i1, i2)),
+                               state.get('cross%i-%i_csicov'%(i1, i2)))
+        cross_txt.close()
+        logger.info('Created %s'%(os.path.join(GRATOOLS_OUT, 
+                                               '%s_%s_csiEcross.txt' \
+                                                   %(out_label, binning_label))))
 
 def main():
     nside = 256
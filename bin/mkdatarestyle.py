@@ -20,6 +20,7 @@ import imp
 import numpy as np
 import healpy as hp
 import pyfits as pf
+import multiprocessing
 
 __description__ = 'Computes fluxes'
 
@@ -33,10 +34,16 @@ from scipy.optimize import curve_fit
 from GRATools import GRATOOLS_OUT
 from GRATools import GRATOOLS_CONFIG
 from GRATools.utils.matplotlib_ import pyplot as plt
-from GRATools.utils.logging_ import logger, startmsg
+from GRATools.utils.logging_ import logger, abort, startmsg
 from  GRATools.utils.gFTools import get_energy_from_fits
 from GRATools.utils.gFTools import get_crbkg
 from GRATools.utils.gSpline import xInterpolatedUnivariateSplineLinear
+from GRATools.utils.gMicroBins import get_micro_store_dir, open_micro_store
+from GRATools.utils.gMicroBins import micro_bins_filled, read_micro_bins
+from GRATools.utils.gMicroBins import write_micro_bins, reduce_micro_bins
+from GRATools.utils.gMicroBins import add_micro_bins, get_micro_runs
+from GRATools.utils.gMicroBins import save_micro_index
+from GRATools.utils.gMaskCache import get_mask
 
 formatter = argparse.ArgumentDefaultsHelpFormatter
 PARSER = argparse.ArgumentParser(description=__description__,
@@ -48,6 +55,20 @@ PARSER.add_argument('--udgrade', type=int, default=512,
 PARSER.add_argument('--foresub', type=ast.literal_eval, choices=[True, False],
                     default=False,
                     help='galactic foreground subtractin activated')
+PARSER.add_argument('--stream', type=ast.literal_eval, choices=[True, False],
+                    default=False,
+                    help='read one year and one micro bin at a time, '
+                    'accumulating them in running sums (bounded memory)')
+PARSER.add_argument('--ncores', type=int, required=False, default=1,
+                    help='Number of cores used to read the yearly files in '
+                    'parallel')
+PARSER.add_argument('--partial', type=ast.literal_eval,
+                    choices=[True, False], default=False,
+                    help='write the flux maps in the partial-sky fits format')
+PARSER.add_argument('--incremental', type=ast.literal_eval,
+                    choices=[True, False], default=False,
+                    help='add to the micro-bin store only the labels of '
+                    'IN_LABELS_LIST not yet included (e.g. new weeks)')
 
 def get_var_from_file(filename):
     f = open(filename)
@@ -55,6 +76,157 @@ def get_var_from_file(filename):
     data = imp.load_source('data', '', f)
     f.close()
 
+def stream_micro_maps(in_labels_list, minb, maxb, nside):
+    """Returns the (Nmicro, Npix) arrays of the counts and of the mean
+       exposure of the micro bins from minb to maxb (included), summed over
+       the gtbin and gtexpcube2 files of the given labels, and the energy
+       binning of the micro bins.
+
+       The files are read one year and one micro bin (one field) at a time
+       and added to preallocated running sums, so that the memory usage
+       does not depend on the number of years.
+
+       in_labels_list: list
+           labels of the *_outfiles.txt files
+       minb, maxb: int
+           first and last micro bin
+       nside: int
+           nside of the output maps
+    """
+    nmicro = maxb - minb + 1
+    npix = hp.nside2npix(nside)
+    counts = np.zeros((nmicro, npix))
+    exps = np.zeros((nmicro, npix))
+    emin, emax, emean = [], [], []
+    for label in in_labels_list:
+        txt_name = os.path.join(GRATOOLS_OUT, '%s_outfiles.txt' %label)
+        txt = open(txt_name,'r')
+        logger.info('Ref: %s'%label)
+        for line in txt:
+            fits_file = line.strip()
+            if 'gtbin' in line:
+                for k in range(0, nmicro):
+                    cmap = hp.read_map(fits_file, field=minb+k, verbose=False)
+                    counts[k] += hp.pixelfunc.ud_grade(cmap, nside, pess=True,
+                                                       power=-2)
+                emin, emax, emean = get_energy_from_fits(fits_file,
+                                                         minbinnum=minb,
+                                                         maxbinnum=maxb+1)
+            if 'gtexpcube2' in line:
+                emap = hp.read_map(fits_file, field=minb, verbose=False)
+                emap_low = hp.pixelfunc.ud_grade(emap, nside, pess=True)
+                for k in range(0, nmicro):
+                    emap = hp.read_map(fits_file, field=minb+k+1,
+                                       verbose=False)
+                    emap_high = hp.pixelfunc.ud_grade(emap, nside, pess=True)
+                    exps[k] += np.sqrt(emap_low*emap_high)
+                    emap_low = emap_high
+        txt.close()
+    return counts, exps, emin, emax, emean
+
+def read_year(args):
+    """worker function: returns the counts and mean exposure arrays of the
+       micro bins of a single year (see stream_micro_maps) and its energy
+       binning.
+    """
+    label, minb, maxb, nside = args
+    counts, exps, emin, emax, emean = stream_micro_maps([label], minb, maxb,
+                                                        nside)
+    return counts, exps, (emin, emax, emean)
+
+def tree_sum(partials):
+    """Returns the sums of the counts and exposure arrays returned by
+       read_year (and the energy binning, the same for all the years).
+
+       The partial sums are combined pairwise as they come (tree
+       reduction), keeping at most log2(N) of them in memory.
+    """
+    stack = []
+    for counts, exps, ebinning in partials:
+        level = 0
+        while len(stack) > 0 and stack[-1][0] == level:
+            _level, _counts, _exps = stack.pop()
+            counts = _counts + counts
+            exps = _exps + exps
+            level += 1
+        stack.append((level, counts, exps))
+    _level, counts, exps = stack.pop()
+    while len(stack) > 0:
+        _level, _counts, _exps = stack.pop()
+        counts = _counts + counts
+        exps = _exps + exps
+    return counts, exps, ebinning
+
+def sum_labels(labels, minb, maxb, nside, ncores=1):
+    """Returns the counts and mean exposure arrays of the micro bins from
+       minb to maxb (included) summed over the given labels, and their
+       energy binning, reading the labels in parallel if ncores > 1.
+    """
+    if ncores > 1:
+        p = multiprocessing.Pool(processes=ncores)
+        args = [(label, minb, maxb, nside) for label in labels]
+        counts, exps, (emin, emax, emean) = tree_sum(p.imap(read_year, args))
+        p.close()
+        p.join()
+        return counts, exps, emin, emax, emean
+    return stream_micro_maps(labels, minb, maxb, nside)
+
+def get_label_signature(label):
+    """Returns the list of the [name, size, modification time] of the
+       gtbin and gtexpcube2 files of a label, to detect changed inputs.
+    """
+    txt_name = os.path.join(GRATOOLS_OUT, '%s_outfiles.txt' %label)
+    signature = []
+    txt = open(txt_name,'r')
+    for line in txt:
+        if 'gtbin' in line or 'gtexpcube2' in line:
+            fits_file = line.strip()
+            signature.append([fits_file, os.path.getsize(fits_file),
+                              int(os.path.getmtime(fits_file))])
+    txt.close()
+    return signature
+
+def update_micro_store(store, in_labels_list, micro_bins, nside, ncores=1):
+    """Incremental ingestion: adds to the micro bins already in the store
+       the labels of in_labels_list not yet in its manifest, and fills the
+       missing micro bins (among the given ones) with all the labels.
+       Returns the list of the micro bins that changed.
+    """
+    manifest = store['index']['labels']
+    filled = np.where(store['index']['filled'])[0]
+    if len(filled) > 0 and len(manifest) == 0:
+        abort('The micro-bin store %s has no manifest: rebuild it'\
+                  %store['dir'])
+    for label in manifest:
+        if label not in in_labels_list:
+            abort('%s is in the micro-bin store but not in IN_LABELS_LIST'\
+                      %label)
+        if manifest[label] != get_label_signature(label):
+            abort('The files of %s changed since they were added to the '
+                  'micro-bin store: rebuild it'%label)
+    new_labels = [label for label in in_labels_list if label not in manifest]
+    missing = np.setdiff1d(micro_bins, filled)
+    changed = list(missing)
+    if len(new_labels) > 0:
+        logger.info('New labels: %s'%str(new_labels))
+        for first, last in get_micro_runs(filled):
+            logger.info('Adding micro bins %i-%i...'%(first, last))
+            counts, exps, emin, emax, emean = sum_labels(new_labels, first,
+                                                         last, nside, ncores)
+            add_micro_bins(store, first, counts, exps)
+        changed += list(filled)
+    for first, last in get_micro_runs(missing):
+        logger.info('Filling micro bins %i-%i...'%(first, last))
+        counts, exps, emin, emax, emean = sum_labels(in_labels_list, first,
+                                                     last, nside, ncores)
+        write_micro_bins(store, first, counts, exps, emin, emax)
+    for label in new_labels:
+        manifest[label] = get_label_signature(label)
+    save_micro_index(store)
+    if len(changed) == 0:
+        logger.info('Micro-bin store up to date.')
+    return changed
+
 def mkRestyle(**kwargs):
     """
     """
@@ -77,50 +249,54 @@ def mkRestyle(**kwargs):
     norm_list = []
     const_list = []
     fore_mean_list = []
+    fore_cube = None
     #all_counts, all_exps = [], []
     #flux_map = []
+    store = open_micro_store(get_micro_store_dir(out_label, kwargs['udgrade']),
+                             data.MICRO_NBINS, kwargs['udgrade'])
+    manifest = store['index']['labels']
+    if kwargs['incremental'] == True:
+        all_micro_bins = np.concatenate([np.arange(minb, maxb+1) \
+                                             for (minb, maxb) in macro_bins])
+        changed = update_micro_store(store, in_labels_list, all_micro_bins,
+                                     kwargs['udgrade'], kwargs['ncores'])
+    elif len(manifest) > 0 and set(manifest) != set(in_labels_list):
+        abort('The micro-bin store was built from %s: use --incremental True'
+              %str([str(label) for label in sorted(manifest)]))
     for i, (minb, maxb) in enumerate(macro_bins):
         all_counts, all_exps = [], []
-        flux_map = []
         micro_bins = np.arange(minb, maxb+1)
         print micro_bins
         logger.info('Considering bins from %i to %i...' %(minb, maxb-1))
         mask_file = data.MASK_FILE
         if type(mask_file) == list:
             mask_file = mask_file[i]
-        mask = hp.read_map(mask_file)
-        _unmask = np.where(mask != 0)[0]
+        mask = get_mask(mask_file)
+        _unmask = mask.unmask
         maxb = maxb + 1
-        exists_counts_files, exists_exp_files = [], []
-        for mb in micro_bins:
-            micro_count_name = os.path.join(GRATOOLS_OUT, 
-                                            'output_counts/%s_counts_%i.fits'
-                                            %(out_label, mb))
-            micro_exp_name = os.path.join(GRATOOLS_OUT,
-                                          'output_counts/%s_exposure_%i.fits'
-                                          %(out_label, mb))
-            if os.path.exists(micro_count_name):
-                exists_counts_files.append(micro_count_name)
-                exists_exp_files.append(micro_exp_name)
-        if len(exists_counts_files) == len(micro_bins):
-            emin, emax, emean = [], [], []
-            E_MIN, E_MAX, E_MEAN = 0, 0, 0
-            txt_name = os.path.join(GRATOOLS_OUT, '%s_outfiles.txt' 
-                                    %in_labels_list[0])
-            txt = open(txt_name,'r')
-            for line in txt:
-                if 'gtbin' in line:
-                    emin, emax, emean = get_energy_from_fits(line,
-                                                             minbinnum=minb,
-                                                             maxbinnum=maxb)
-                    E_MIN, E_MAX = emin[0], emax[-1]
-                    E_MEAN = np.sqrt(emax[0]*emin[-1])
+        filled = micro_bins_filled(store, minb, maxb-1)
+        if filled:
             logger.info('Counts and exposure maps ready! Retriving them...')
-            for j in range(0, len(micro_bins)):
-                cc = hp.read_map(exists_counts_files[j])
-                ee = hp.read_map(exists_exp_files[j])
-                all_counts.append(cc)
-                all_exps.append(ee)
+            all_counts, all_exps, emin, emax = read_micro_bins(store, minb,
+                                                               maxb-1)
+            emean = np.sqrt(emin*emax)
+            E_MIN, E_MAX = emin[0], emax[-1]
+            E_MEAN = np.sqrt(emax[0]*emin[-1])
+        elif kwargs['ncores'] > 1:
+            logger.info('Reading count and exposure maps with %i cores...'\
+                            %kwargs['ncores'])
+            all_counts, all_exps, emin, emax, emean = \
+                sum_labels(in_labels_list, minb, maxb-1, kwargs['udgrade'],
+                           kwargs['ncores'])
+            E_MIN, E_MAX = emin[0], emax[-1]
+            E_MEAN = np.sqrt(emax[0]*emin[-1])
+        elif kwargs['stream'] == True:
+            logger.info('Streaming count and exposure maps...')
+            all_counts, all_exps, emin, emax, emean = \
+                stream_micro_maps(in_labels_list, minb, maxb-1,
+                                  kwargs['udgrade'])
+            E_MIN, E_MAX = emin[0], emax[-1]
+            E_MEAN = np.sqrt(emax[0]*emin[-1])
         else:
             logger.info('Retriving count and exposure maps...')
             emin, emax, emean = [], [], []
@@ -160,34 +336,20 @@ def mkRestyle(**kwargs):
                 all_counts = all_counts + count_map[t]
                 all_exps = all_exps + exp_mean_map[t]
 
-            for i, cmap in enumerate(all_counts):
-                micro_count_name = os.path.join(GRATOOLS_OUT, 
-                                                'output_counts/%s_counts_%i.fits'
-                                                %(out_label, micro_bins[i]))
-                hp.write_map(micro_count_name, cmap)
-                micro_exp_name = os.path.join(GRATOOLS_OUT, 
-                                              'output_counts/%s_exposure_%i.fits'
-                                              %(out_label, micro_bins[i]))
-                hp.write_map(micro_exp_name, all_exps[i])
+        if not filled:
+            write_micro_bins(store, minb, all_counts, all_exps, emin, emax)
+            for label in in_labels_list:
+                if label not in manifest:
+                    manifest[label] = get_label_signature(label)
+            save_micro_index(store)
 
-        logger.info('Computing the flux for each micro energy bin...')
-        nside = kwargs['udgrade']
-        npix = hp.nside2npix(nside)
-        sr = 4*np.pi/npix
-        iii = np.arange(npix)
-        for i, cmap in enumerate(all_counts):
-            flux_map.append(cmap/all_exps[i]/sr)
-    
-        # now I have finelly gridded (in energy) summed in time fluxes
+        # now I have finelly gridded (in energy) summed in time maps
         logger.info('Rebinning...')
         logger.info('Merging fluxes from %.2f to %.2f MeV' %(E_MIN, E_MAX))
-        macro_fluxerr = (emean[0]/emean[0])**(-gamma)/(all_exps[0])**2
-        macro_counts = all_counts[0]
-        macro_flux = flux_map[0]
 
         # implement foreground subtraction
         if kwargs['foresub'] == True:
-            from GRATools.utils.gFTools import get_foreground_integral_flux_map
+            from GRATools.utils.gForeCube import ForegroundCube
             from GRATools.utils.gFTools import fit_foreground
             from GRATools.utils.gFTools import flux2counts
             out_fore_folder = os.path.join(GRATOOLS_OUT, 'output_fore')
@@ -198,72 +360,52 @@ def mkRestyle(**kwargs):
                                                   %(E_MIN, E_MAX))
             if not os.path.exists(out_fore_folder):
                 os.makedirs(out_fore_folder)
-            all_fore = []
-            all_countfore = []
-            for e1, e2 in zip(emin, emax):
-                fore = get_foreground_integral_flux_map(fore_files, e1, e2)
-                counts_fore = flux2counts(fore, all_exps[0])
-                all_fore.append(fore)
-                all_countfore.append(counts_fore)
-            tot_counts = sum(all_counts)
-            tot_flux = sum(flux_map)
-            tot_fore = sum(all_fore)
-            tot_countfore = sum(all_countfore)
-            n0, c0 = fit_foreground(tot_fore, tot_flux)   
-            #macro_flux = (all_counts[0] - n0*(all_countfore[0]))/all_exps[0]/sr
-            
-            macro_fore = all_fore[0]
-            macro_countfore = all_countfore[0]
-            CN = np.mean(all_counts[0][_unmask]/(all_exps[0][_unmask])**2)/sr
-            for b in range(1, len(flux_map)):
-                #n, c = fit_foreground(all_countfore[b], all_counts[b])
-                #logger.info('Norm fact = %.3f'%n)
-                fluxerr = (emean[b]/emean[0])**(-gamma)/(all_exps[b])**2
-                macro_fluxerr = macro_fluxerr + fluxerr
-                macro_flux = macro_flux+(all_counts[b] - n0*(all_countfore[b]))/\
-                    all_exps[b]/sr
-                macro_counts = macro_counts + all_counts[b]
-                macro_fore = macro_fore + all_fore[b]
-                macro_countfore = macro_countfore + all_countfore[b]
-                CN = CN + np.mean(all_counts[b][_unmask]/ \
-                                      (all_exps[b][_unmask])**2)/sr
-            macro_flux = tot_flux - n0*tot_fore
+            if fore_cube is None:
+                fore_cube = ForegroundCube(fore_files)
+            all_fore = fore_cube.integral_flux(zip(emin, emax))
+            # the foreground fit needs the flux in the whole sky
+            tot_flux, macro_fluxerr, macro_counts, CN = \
+                reduce_micro_bins(all_counts, all_exps, emean, gamma, _unmask,
+                                  pix=np.arange(mask.npix))
+            macro_fore = np.sum(all_fore, axis=0)
+            macro_countfore = flux2counts(macro_fore, all_exps[0])
+            n0, c0 = fit_foreground(macro_fore, tot_flux.values)   
+            macro_flux = (tot_flux - n0*macro_fore).restrict(_unmask)
+            macro_fluxerr = macro_fluxerr.restrict(_unmask)
             logger.info('CN (white noise) term = %e'%CN)
-            macro_fluxerr = (np.sqrt(all_counts[0]*macro_fluxerr)/sr)
             macro_fore_masked = hp.ma(macro_fore)
-            macro_fore_masked.mask = np.logical_not(mask)
-            hp.write_map(out_name_fore, macro_fore, coord='G')
-            hp.write_map(out_name_forecount, macro_countfore, coord='G')
+            macro_fore_masked.mask = mask.ma_mask()
+            hp.write_map(out_name_fore, macro_fore, coord='G',
+                         overwrite=True)
+            hp.write_map(out_name_forecount, macro_countfore, coord='G',
+                         overwrite=True)
             logger.info('Created %s' %out_name_fore)
             logger.info('Created %s' %out_name_forecount)
             FORE_MEAN = np.mean(macro_fore[_unmask])
             print 'MEAN FORE FLUX: ', FORE_MEAN
             fore_mean_list.append(FORE_MEAN)
         else:
-            CN = np.mean(all_counts[0][_unmask]/(all_exps[0][_unmask])**2)/sr
-            macro_flux = flux_map[0]
-            for b in range(1, len(flux_map)):
-                fluxerr = (emean[b]/emean[0])**(-gamma)/(all_exps[b])**2
-                macro_fluxerr = macro_fluxerr + fluxerr
-                macro_flux = macro_flux + flux_map[b]
-                macro_counts = macro_counts + all_counts[b]
-                CN = CN + np.mean(all_counts[b][_unmask]/ \
-                                      (all_exps[b][_unmask])**2)/sr
+            macro_flux, macro_fluxerr, macro_counts, CN = \
+                reduce_micro_bins(all_counts, all_exps, emean, gamma, _unmask)
             logger.info('CN (white noise) term = %e'%CN)
-            macro_fluxerr = (np.sqrt(all_counts[0]*macro_fluxerr)/sr)
         
         out_count_folder = os.path.join(GRATOOLS_OUT, 'output_counts')
         if not os.path.exists(out_count_folder):
             os.makedirs(out_count_folder)
         out_counts_name = os.path.join(out_count_folder,out_label+'_counts_%i-%i.fits'\
                                       %(E_MIN, E_MAX))
-        logger.info('Created %s' %out_counts_name)
-        hp.write_map(out_counts_name, macro_counts, coord='G')
-        # now mask the rebinned flux and error maps        
-        macro_flux_masked = hp.ma(macro_flux)
-        macro_fluxerr_masked = hp.ma(macro_fluxerr)
-        macro_flux_masked.mask = np.logical_not(mask)
-        macro_fluxerr_masked.mask = np.logical_not(mask)
+        write_maps = True
+        if kwargs['incremental'] == True and \
+                len(np.intersect1d(micro_bins, changed)) == 0 and \
+                os.path.exists(out_counts_name):
+            logger.info('Input unchanged: keeping the existing maps.')
+            write_maps = False
+        if write_maps == True:
+            logger.info('Created %s' %out_counts_name)
+            # the maps of the bins changed by --incremental are replaced
+            hp.write_map(out_counts_name, macro_counts, coord='G',
+                         overwrite=True)
+        # the rebinned flux and error maps are defined in the unmasked pixels
         out_folder = os.path.join(GRATOOLS_OUT, 'output_flux')
         if not os.path.exists(out_folder):
             os.makedirs(out_folder)
@@ -271,17 +413,19 @@ def mkRestyle(**kwargs):
                                       %(mask_label, E_MIN, E_MAX))
         out_name_err = os.path.join(out_folder, out_label+'_%s_fluxerr_%i-%i.fits'\
                                         %(mask_label, E_MIN, E_MAX))
-        logger.info('Created %s' %out_name)
-        logger.info('Created %s' %out_name_err)
-        hp.write_map(out_name, macro_flux_masked, coord='G')
-        hp.write_map(out_name_err, macro_fluxerr_masked, coord='G')
-        F_MEAN = np.sum(macro_flux[_unmask])/len(macro_flux[_unmask])
+        if write_maps == True:
+            logger.info('Created %s' %out_name)
+            logger.info('Created %s' %out_name_err)
+            macro_flux.write(out_name, coord='G', partial=kwargs['partial'],
+                             overwrite=True)
+            macro_fluxerr.write(out_name_err, coord='G',
+                                partial=kwargs['partial'], overwrite=True)
+        F_MEAN = macro_flux.mean()
         crbkg = get_crbkg(crbkg_file)
         logger.info('Subtracting CR residual bkg...')
         #F_MEAN = F_MEAN - (E_MAX-E_MIN)*crbkg(E_MEAN)/E_MEAN**2
-        FERR_MEAN = np.sqrt(np.sum(macro_fluxerr[_unmask]**2))/\
-                                   len(macro_flux[_unmask])
-        FSKY = float(len(macro_flux[_unmask]))/float(len(macro_flux))
+        FERR_MEAN = np.sqrt((macro_fluxerr**2).sum())/len(macro_flux)
+        FSKY = macro_flux.fsky()
         logger.info('Fsky = %.3f'%FSKY)
         print 'F_MEAN, FERR_MEAN = ', F_MEAN, FERR_MEAN
         new_txt.write('%.2f \t %.2f \t %.2f \t %e \t %e \t %e \t %f \n' \
@@ -35,6 +35,7 @@ from GRATools import GRATOOLS_OUT, GRATOOLS_CONFIG
 from GRATools.utils.logging_ import logger, startmsg
 from GRATools.utils.matplotlib_ import pyplot as plt
 from GRATools.utils.matplotlib_ import overlay_tag, save_current_figure
+from GRATools.utils.gMaskCache import get_mask
 
 GRATOOLS_OUT_FORE = os.path.join(GRATOOLS_OUT, 'output_fore')
 
@@ -72,7 +73,7 @@ def mkForeCl(**kwargs):
         mask_file = data.MASK_FILE
         if type(mask_file) == list:
             mask_file = mask_file[i]
-        mask = hp.read_map(mask_file)
+        mask = get_mask(mask_file)
         logger.info('Considering bin %.2f - %.2f ...'%(emin, emax))
         cl_txt.write('ENERGY\t %.2f %.2f %.2f\n'%(emin, emax, _emean[i]))
         l_max= 1000
@@ -80,7 +81,7 @@ def mkForeCl(**kwargs):
         flux_map_name = in_label+'_fore_%i-%i.fits'%(emin, emax)
         flux_map = hp.read_map(os.path.join(GRATOOLS_OUT_FORE, flux_map_name))
         flux_map_masked = hp.ma(flux_map)
-        flux_map_masked.mask = np.logical_not(mask)
+        flux_map_masked.mask = mask.ma_mask()
         fsky = 1.-(len(np.where(flux_map_masked.filled() == hp.UNSEEN)[0])/\
                        float(len(flux_map)))
         if kwargs['show'] == True:
@@ -15,6 +15,7 @@
 
 import os
 import ast
+import multiprocessing
 import argparse
 import numpy as np
 import healpy as hp
@@ -24,7 +25,8 @@ from GRATools import GRATOOLS_CONFIG
 from GRATools.utils.logging_ import logger, abort, startmsg
 from GRATools.utils.matplotlib_ import pyplot as plt
 from GRATools.utils.matplotlib_ import overlay_tag, save_current_figure
-from GRATools.utils.gSpline import xInterpolatedBivariateSplineLinear
+from GRATools.utils.gReproject import car2healpix_operator, reproject_planes
+from GRATools.utils.gReproject import get_area_operator
 
 __description__ = 'Converter from Cartesian to healpix format'
 
@@ -36,49 +38,105 @@ PARSER.add_argument('--infile', type=str, required=True,
                     help='input fits file')
 PARSER.add_argument('--nsideout', type=int, default=512,
                     help='')
+PARSER.add_argument('--method', type=str, default='area',
+                    choices=['area', 'interp'],
+                    help='area: average of the CAR cells over each pixel at \
+nsideout; interp: bilinear interpolation at nsideinterp, then ud_grade')
+PARSER.add_argument('--nsub', type=int, default=4,
+                    help='sub-pixels along each side of a pixel (area method)')
+PARSER.add_argument('--nsideinterp', type=int, default=2048,
+                    help='nside at which the cube is interpolated (interp \
+method)')
+PARSER.add_argument('--ncores', type=int, default=1,
+                    help='number of processes converting the energy planes')
+PARSER.add_argument('--batch', type=int, default=4,
+                    help='number of energy planes converted at once')
+
+REPROJ_WORKER = {}
+
+def init_reproj_worker(input_file, operator, nside_out):
+    """Initializer of the worker processes: the reprojection operator is
+       inherited from the parent process
+    """
+    REPROJ_WORKER['input_file'] = input_file
+    REPROJ_WORKER['operator'] = operator
+    REPROJ_WORKER['nside_out'] = nside_out
+
+def reproject_batch(planes):
+    """worker function: returns the given energy planes of the cube
+       converted into healpix maps at nside_out
+    """
+    nside_out = REPROJ_WORKER['nside_out']
+    frmaps = pf.open(REPROJ_WORKER['input_file'], memmap=True)
+    hp_frmaps = reproject_planes(REPROJ_WORKER['operator'],
+                                 frmaps[0].data[planes[0]:planes[-1]+1])
+    frmaps.close()
+    if hp.npix2nside(hp_frmaps.shape[1]) != nside_out:
+        hp_frmaps = [hp.pixelfunc.ud_grade(hp_frmap, nside_out,  pess=True) \
+                         for hp_frmap in hp_frmaps]
+    return planes, np.array(hp_frmaps, dtype=np.float32)
 
 def foreground_map_convert(**kwargs):
-    """Viewer interface for healpix maps
+    """Converts all the energy planes of a CAR cube into a single
+       multi-field healpix cube (one field for each energy, plus the
+       ENERGIES extension)
     """
     input_file = kwargs['infile']
     nside_out = kwargs['nsideout']
     if not os.path.exists(input_file):
         abort("Map %s not found!"%input_file)
-    frmaps = pf.open(input_file)
-    maps_slices = frmaps[0].data
+    frmaps = pf.open(input_file, memmap=True)
+    nlat, nlon = frmaps[0].data.shape[1:]
     energy = np.array([x[0] for x in frmaps['ENERGIES'].data])
-    nside = 2048
-    npix = hp.nside2npix(nside)
-    iii = np.arange(npix)
-    x,y,z = hp.pix2vec(nside, iii)
-    lon_hp, lat_hp = hp.rotator.vec2dir(x,y,z,lonlat=True)
-    hp_frmap = np.arange(npix, dtype=np.float64)
-    lon_fits = np.arange(len(maps_slices[0][0]))
+    frmaps.close()
+    lon_fits = np.arange(nlon)
     nresx = 360./len(lon_fits)
     lon_fits_1 = (lon_fits[:1440]*nresx+180)
     lon_fits = np.append(lon_fits_1, lon_fits[1440:]*nresx-180)#+180
-    lat_fits = np.arange(len(maps_slices[0]))
+    lat_fits = np.arange(nlat)
     lat_fits = lat_fits*nresx-90
-    fr_e = []
-    for i, en in enumerate(energy):
-        logger.info('Running map convertion for energy %.2f...'%en)
-        frmap = maps_slices[i]
-        fmt = dict(xname='$l$', xunits='deg', yname='$b$',
-                   yunits='deg', zname='Flux [cm$^{-2}$s$^{-1}$sr$^{-1}$]')
-        lon, _indexx = np.unique(lon_fits, return_index=True)
-        lat, _indexy = np.unique(lat_fits, return_index=True)
-        frmap = frmap[:, _indexx]
-        frspline = xInterpolatedBivariateSplineLinear(lon, lat, frmap.T, **fmt)
-        for i, pix in enumerate(hp_frmap):
-            hp_frmap[i] = frspline((lon_hp[i]+360)%360, lat_hp[i])
-        out_name = os.path.basename(input_file).replace('.fits','_hp%i_%d.fits' 
-                                                        %(nside_out, en))
-        fr_e.append(hp_frmap[12426])
-        out_path = os.path.join(GRATOOLS_CONFIG, 'fits', out_name)
-        hp_frmap_out = hp.pixelfunc.ud_grade(hp_frmap, nside_out,  pess=True)
-        hp.write_map(out_path, hp_frmap_out, coord='G')
-        logger.info('Writed map %s'%out_path)
-    frmaps.close()
+    out_folder = os.path.join(GRATOOLS_CONFIG, 'fits')
+    # the weights are computed once for all the planes
+    if kwargs['method'] == 'area':
+        operator = get_area_operator(out_folder, lon_fits, lat_fits,
+                                     nside_out, kwargs['nsub'])
+    else:
+        operator = car2healpix_operator(lon_fits, lat_fits,
+                                        kwargs['nsideinterp'])
+    batch = max(kwargs['batch'], 1)
+    batches = [range(i, min(i + batch, len(energy))) for i in \
+                   range(0, len(energy), batch)]
+    logger.info('Running map convertion for %i energies...'%len(energy))
+    init_args = (input_file, operator, nside_out)
+    if kwargs['ncores'] > 1:
+        p = multiprocessing.Pool(processes=kwargs['ncores'],
+                                 initializer=init_reproj_worker,
+                                 initargs=init_args)
+        results = p.imap(reproject_batch, batches)
+    else:
+        init_reproj_worker(*init_args)
+        results = (reproject_batch(planes) for planes in batches)
+    hp_cube = np.zeros((len(energy), hp.nside2npix(nside_out)),
+                       dtype=np.float32)
+    for planes, hp_frmaps in results:
+        hp_cube[planes] = hp_frmaps
+        logger.info('Converted energies %s'\
+                        %', '.join(['%.2f'%en for en in energy[planes]]))
+    if kwargs['ncores'] > 1:
+        p.close()
+        p.join()
+    out_name = os.path.basename(input_file).replace('.fits','_hp%i_cube.fits' 
+                                                    %nside_out)
+    out_path = os.path.join(out_folder, out_name)
+    hp.write_map(out_path, hp_cube, coord='G',
+                 column_names=['E%i'%i for i in range(len(energy))])
+    hdulist = pf.open(out_path, mode='append')
+    energy_col = pf.Column(name='Energy', format='D', unit='MeV',
+                           array=energy)
+    hdulist.append(pf.BinTableHDU.from_columns([energy_col], 
+                                               name='ENERGIES'))
+    hdulist.close()
+    logger.info('Writed map %s'%out_path)
 
 if __name__ == '__main__':
     args = PARSER.parse_args()
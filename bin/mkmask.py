@@ -57,6 +57,11 @@ PARSER.add_argument('--eastmask', type=ast.literal_eval, choices=[True, False],
 PARSER.add_argument('--westmask', type=ast.literal_eval, choices=[True, False],
                     default=False,
                     help='westhern hemispheremask activated')
+PARSER.add_argument('--apotype', type=str, default=None,
+                    choices=['C1', 'C2', 'gaussian'],
+                    help='apodization taper of the mask (none by default)')
+PARSER.add_argument('--aposize', type=float, default=1.,
+                    help='apodization scale [deg]')
 
 
 def get_var_from_file(filename):
@@ -66,48 +71,74 @@ def get_var_from_file(filename):
     f.close()
 
 def mkMask(**kwargs):
-    """
+    """Writes the mask with the activated components. If ENERGY in the
+       config file is a list, the masks of all the energies (which differ
+       only in the flux-weighted sources mask) are built in one pass and
+       written as the fields of a single file, with the fsky of each energy
+       in its ENERGIES extension.
     """
     logger.info('Starting mask production...')
     get_var_from_file(kwargs['config'])
-    bad_pix = []
     nside = data.NSIDE
     out_label = data.OUT_LABEL
     energy = data.ENERGY
     npix = hp.nside2npix(nside)
-    mask = np.ones(npix)
+    # the components are boolean arrays of the bad pixels, combined in OR
+    # (one row for each energy)
+    bad = np.zeros((len(np.atleast_1d(energy)), npix), dtype=bool)
     if kwargs['srcmask'] == True:
         from GRATools.utils.gMasks import mask_src
         src_mask_rad = data.SRC_MASK_RAD
         cat_file = data.SRC_CATALOG
-        bad_pix += mask_src(cat_file, src_mask_rad, nside)
+        bad |= mask_src(cat_file, src_mask_rad, nside)
     if kwargs['srcmaskweight'] == True:
         from GRATools.utils.gMasks import mask_src_weighted
         src_mask_rad = data.SRC_MASK_RAD
         cat_file = data.SRC_CATALOG
-        bad_pix += mask_src_weighted(cat_file, energy, nside)
+        bad |= mask_src_weighted(cat_file, energy, nside)
     if kwargs['gpmask'] == True:
         from GRATools.utils.gMasks import mask_gp
         gp_mask_lat = data.GP_MASK_LAT
-        bad_pix += mask_gp(gp_mask_lat, nside)  
+        bad |= mask_gp(gp_mask_lat, nside)  
     if kwargs['northmask'] == True:
         from GRATools.utils.gMasks import mask_hemi_north
-        bad_pix += mask_hemi_north(nside) 
+        bad |= mask_hemi_north(nside) 
     if kwargs['southmask'] == True:
         from GRATools.utils.gMasks import mask_hemi_south
-        bad_pix += mask_hemi_south(nside) 
+        bad |= mask_hemi_south(nside) 
     if kwargs['eastmask'] == True:
         from GRATools.utils.gMasks import mask_hemi_east
-        bad_pix += mask_hemi_east(nside) 
+        bad |= mask_hemi_east(nside) 
     if kwargs['westmask'] == True:
         from GRATools.utils.gMasks import mask_hemi_west
-        bad_pix += mask_hemi_west(nside) 
-    for bpix in np.unique(bad_pix):
-        mask[bpix] = 0
+        bad |= mask_hemi_west(nside) 
+    mask = np.logical_not(bad).astype(float)
+    if kwargs['apotype'] is not None:
+        from GRATools.utils.gMasks import apodize_mask
+        for k in range(0, len(mask)):
+            mask[k] = apodize_mask(mask[k], kwargs['aposize'],
+                                   kwargs['apotype'])
+        out_label = out_label + '_%s-%.2fdeg'%(kwargs['apotype'],
+                                               kwargs['aposize'])
     out_name = os.path.join(GRATOOLS_CONFIG, 'fits/'+out_label+'.fits')
-    fsky = 1-(len(np.unique(bad_pix))/float(npix))
-    logger.info('f$_{sky}$ = %.3f'%fsky)
-    hp.write_map(out_name, mask, coord='G')
+    # mean of the squared mask (the w2 normalization of the pseudo-Cl), i.e.
+    # the fraction of unmasked pixels for a binary mask
+    fsky = np.mean(mask**2, axis=1)
+    if np.ndim(energy) == 0:
+        logger.info('f$_{sky}$ = %.3f'%fsky[0])
+        hp.write_map(out_name, mask[0], coord='G')
+    else:
+        for en, fs in zip(energy, fsky):
+            logger.info('E = %.2f MeV: f$_{sky}$ = %.3f'%(en, fs))
+        hp.write_map(out_name, mask, coord='G',
+                     column_names=['E%i'%i for i in range(len(energy))])
+        hdulist = pf.open(out_name, mode='append')
+        energy_col = pf.Column(name='Energy', format='D', unit='MeV',
+                               array=np.array(energy, dtype=float))
+        fsky_col = pf.Column(name='Fsky', format='D', array=fsky)
+        hdulist.append(pf.BinTableHDU.from_columns([energy_col, fsky_col],
+                                                   name='ENERGIES'))
+        hdulist.close()
     logger.info('Created %s' %out_name)
     
 if __name__ == '__main__':
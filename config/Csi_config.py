@@ -37,6 +37,7 @@ DICT_GTPSF = {'expcube': LTCUBE,
 """Csi VARIABLES
 """
 IN_LABEL = 'Allyrs_UCV_t56_maskweighted' 
+#IN_LABEL2 = 'Allyrs_UCV_t56_maskweighted-mW' #if set, cross Csi with IN_LABEL
 TH_BINNING = np.array([0., 0.00256212, 0.00410109, 0.00656446, 0.00830517, 
                        0.01050748, 0.02692143, 0.05451897, 0.06897592])
 BINNING_LABEL = '13bins'
@@ -28,6 +28,7 @@ from GRATools import FT_DATA_FOLDER
 #OUT_LABEL = 'Mask_advanced-4q_120226-190546'
 #OUT_LABEL = 'Mask_advanced-4q_190546-331131'
 OUT_LABEL = 'Mask_advanced-4q_331131-575439'
+#OUT_LABEL = 'Mask_advanced-4q' # with the list of energies below
 
 NSIDE = 512
 SRC_CATALOG = os.path.join(FT_DATA_FOLDER,'catalogs/gll_psc_v16.fit')
@@ -46,6 +47,9 @@ GP_MASK_LAT = 30.
 #ENERGY = 152802.88
 #ENERGY = 255462.38
 ENERGY = 443942.75
+# list of energies: all the masks in one file (one field for each energy)
+#ENERGY = [743.73, 1340.69, 2208.67, 3692.56, 6416.93, 11151.34, 18370.95,
+#          30713.33, 53373.66, 92752.78, 152802.88, 255462.38, 443942.75]
 
 """my energy bins:
 
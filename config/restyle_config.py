@@ -24,5 +24,9 @@ MICRO_NBINS = 100
 MACRO_BINS = [(18,24),(25,30),(31,35),(36,41),(42,47),(48,53),(54,58),(59,64),(65,70),(71,76),(77,81),(82,87),(88,93)]
 POWER_LOW_INDEX = 2.30
 MASK_FILE = os.path.join(GRATOOLS_CONFIG, 'fits/Mask_src2_gp30.fits')
+# one mask for each macro bin: (file, field) reads a field of the
+# multi-energy masks written by mkmask.py
+#MASK_FILE = [(os.path.join(GRATOOLS_CONFIG, 'fits/Mask_advanced-4q.fits'), i)
+#             for i in range(0, 13)]
 
 
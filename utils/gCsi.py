@@ -0,0 +1,437 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+# On behalf of the Fermi-LAT Collaboration.                                    #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Angular pair-counting utilities for the Csi analysis
+"""
+
+
+import os
+import shutil
+import hashlib
+import itertools
+import multiprocessing
+import numpy as np
+import healpy as hp
+from scipy.spatial import cKDTree
+from GRATools import GRATOOLS_OUT
+from GRATools.utils.logging_ import logger, abort
+
+GRATOOLS_OUT_CSI = os.path.join(GRATOOLS_OUT, 'output_csi')
+
+
+def pix2xyz(nside, pix):
+    """Returns the (N, 3) array of the unit vectors pointing to the
+       centers of the given pixels.
+
+       nside: int
+           healpix nside parameter
+       pix: numpy array
+           indices of the pixels (RING scheme)
+    """
+    x, y, z = hp.pixelfunc.pix2vec(nside, pix)
+    return np.column_stack((x, y, z))
+
+def share_array(arr):
+    """Copies a numpy array into a shared-memory buffer, to be handed to the
+       workers of a multiprocessing.Pool (via the initializer) instead of
+       being pickled with each task.
+
+       Returns the (buffer, dtype, shape) tuple to be passed to attach_array.
+    """
+    arr = np.ascontiguousarray(arr)
+    buf = multiprocessing.RawArray('b', max(arr.nbytes, 1))
+    np.frombuffer(buf, dtype=arr.dtype, count=arr.size)[:] = arr.ravel()
+    return buf, arr.dtype.str, arr.shape
+
+def attach_array(shared):
+    """Returns a read-only numpy view of a buffer created with share_array.
+    """
+    buf, dtype, shape = shared
+    arr = np.frombuffer(buf, dtype=np.dtype(dtype),
+                        count=int(np.prod(shape))).reshape(shape)
+    arr.flags.writeable = False
+    return arr
+
+def theta2chord(theta):
+    """Converts angular distances [rad] into 3D chord distances on the unit
+       sphere.
+    """
+    return 2.*np.sin(0.5*np.asarray(theta, dtype=float))
+
+def chord2theta(chord):
+    """Converts 3D chord distances on the unit sphere into angular
+       distances [rad].
+    """
+    return 2.*np.arcsin(np.clip(0.5*np.asarray(chord, dtype=float), 0., 1.))
+
+def build_pair_tree(xyz):
+    """Returns the KD-tree built over the (N, 3) array of pixel unit vectors.
+    """
+    logger.info('Building the KD-tree over %i pixels...'%len(xyz))
+    return cKDTree(xyz)
+
+def get_theta_bin(theta, th_bins):
+    """Returns the index of the theta bin of each angular distance.
+
+       The bins are (thmin, thmax], as the annuli obtained with hp.query_disc
+       in the original per-pixel estimator; when the binning starts from 0
+       the pixel itself (theta = 0) falls in the first bin. Distances
+       outside the binning get -1.
+    """
+    _bin = np.searchsorted(th_bins, theta, side='left') - 1
+    if th_bins[0] == 0:
+        _bin[theta == 0] = 0
+    _bin[_bin >= len(th_bins) - 1] = -1
+    return _bin
+
+def get_pairs(tree, xyz, th_bins, start, stop):
+    """Returns the pairs of pixels (i, j) with start <= i < stop and j >= i
+       closer than the largest edge of the theta binning, together with the
+       index of the theta bin each pair belongs to.
+
+       All the neighbours of the block of pixels are found with one batched
+       query of the KD-tree in the 3D chord distance.
+
+       tree: scipy.spatial.cKDTree
+           KD-tree built over xyz
+       xyz: numpy array
+           (N, 3) array of pixel unit vectors
+       th_bins: numpy array
+           edges of the theta binning [rad]
+       start, stop: int
+           block of pixels to consider (indices of the xyz array)
+    """
+    max_chord = theta2chord(th_bins[-1])*(1. + 1e-9)
+    neigh = tree.query_ball_point(xyz[start:stop], max_chord)
+    nneigh = np.array([len(n) for n in neigh], dtype=np.int64)
+    j = np.fromiter(itertools.chain.from_iterable(neigh), dtype=np.int64,
+                    count=np.sum(nneigh))
+    i = np.repeat(np.arange(start, stop, dtype=np.int64), nneigh)
+    _upper = np.where(j >= i)[0]
+    i, j = i[_upper], j[_upper]
+    theta = chord2theta(np.sqrt(np.sum((xyz[i] - xyz[j])**2, axis=1)))
+    _bin = get_theta_bin(theta, th_bins)
+    _inbin = np.where(_bin >= 0)[0]
+    return i[_inbin], j[_inbin], _bin[_inbin]
+
+def get_pair_index_dir(nside, th_bins, pix):
+    """Returns the folder of the on-disk pair index of a given geometry.
+
+       The name of the folder is a hash of NSIDE, of the theta binning and
+       of the unmasked pixels, so that all the maps sharing the same
+       geometry (e.g. different energy bins or flux maps with the same
+       mask) share the same index.
+    """
+    key = hashlib.sha1()
+    key.update(np.array([nside], dtype=np.int64).tobytes())
+    key.update(np.asarray(th_bins, dtype=np.float64).tobytes())
+    key.update(np.asarray(pix, dtype=np.int64).tobytes())
+    return os.path.join(GRATOOLS_OUT_CSI, 'pairs_%s'%key.hexdigest()[:16])
+
+def write_pair_index(blocks, npix_unmask, index_dir):
+    """Writes the pair index as a CSR-like structure: for the pixel (row) i
+       the neighbours j >= i are indices[indptr[i]:indptr[i+1]], and the
+       theta bins of the pairs are bins[indptr[i]:indptr[i+1]].
+
+       blocks: iterable
+           blocks of pairs (i, j, bin), as returned by get_pairs, ordered
+           by pixel
+       npix_unmask: int
+           number of (unmasked) pixels
+       index_dir: str
+           output folder (the files are written in a temporary folder that
+           is renamed at the end, so that an interrupted run does not leave
+           a corrupted index)
+    """
+    tmp_dir = index_dir + '_tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    nrow = np.zeros(npix_unmask, dtype=np.int64)
+    f_indices = open(os.path.join(tmp_dir, 'indices.dat'), 'wb')
+    f_bins = open(os.path.join(tmp_dir, 'bins.dat'), 'wb')
+    for i, j, _bin in blocks:
+        if len(i) > 0:
+            nrow[i[0]:i[-1] + 1] += np.bincount(i - i[0])
+        j.astype(np.int32).tofile(f_indices)
+        _bin.astype(np.int16).tofile(f_bins)
+    f_indices.close()
+    f_bins.close()
+    indptr = np.zeros(npix_unmask + 1, dtype=np.int64)
+    np.cumsum(nrow, out=indptr[1:])
+    np.save(os.path.join(tmp_dir, 'indptr.npy'), indptr)
+    os.rename(tmp_dir, index_dir)
+    logger.info('Created %s (%i pairs)'%(index_dir, indptr[-1]))
+
+def load_pair_index(index_dir):
+    """Returns the (indptr, indices, bins) arrays of the pair index written
+       by write_pair_index, memory-mapped (read-only).
+    """
+    indptr = np.load(os.path.join(index_dir, 'indptr.npy'), mmap_mode='r')
+    if indptr[-1] == 0:
+        return indptr, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int16)
+    indices = np.memmap(os.path.join(index_dir, 'indices.dat'),
+                        dtype=np.int32, mode='r')
+    bins = np.memmap(os.path.join(index_dir, 'bins.dat'), dtype=np.int16,
+                     mode='r')
+    return indptr, indices, bins
+
+def get_index_pairs(index, start, stop):
+    """Returns the pairs (i, j, bin) of the rows from start to stop of a pair
+       index loaded with load_pair_index (same output of get_pairs).
+    """
+    indptr, indices, bins = index
+    first, last = indptr[start], indptr[stop]
+    i = np.repeat(np.arange(start, stop, dtype=np.int64),
+                  np.diff(indptr[start:stop + 1]))
+    j = np.array(indices[first:last], dtype=np.int64)
+    _bin = np.array(bins[first:last], dtype=np.int64)
+    return i, j, _bin
+
+def pair_weights(i, j, a, b):
+    """Returns the weight a[i]*b[j] + a[j]*b[i] of each pair with j >= i
+       (a[i]*b[i] for i == j), i.e. its contribution to the sum over the
+       ordered pairs.
+    """
+    w = a[i]*b[j] + a[j]*b[i]
+    w[i == j] *= 0.5
+    return w
+
+def pair_sum(i, j, _bin, a, b, nbins):
+    """Returns, for each theta bin, the sum of a[i]*b[j] over all the ordered
+       pairs (i, j), given the pairs with j >= i as returned by get_pairs.
+    """
+    return np.bincount(_bin, weights=pair_weights(i, j, a, b),
+                       minlength=nbins)
+
+def pair_counts(i, j, _bin, nbins):
+    """Returns, for each theta bin, the number of ordered pairs (i, j),
+       given the pairs with j >= i as returned by get_pairs.
+    """
+    w = np.where(i == j, 1., 2.)
+    return np.bincount(_bin, weights=w, minlength=nbins)
+
+def block_weights(i, j, dI, dR, cross=False):
+    """Returns the list of the pair weights summed by csi_block_sums (one
+       array per row).
+    """
+    dI = np.atleast_2d(dI)
+    dR = np.atleast_2d(dR)
+    nmaps = len(dI)
+    weights = [pair_weights(i, j, dI[e], dI[e]) for e in range(nmaps)]
+    weights.append(np.where(i == j, 1., 2.))
+    weights += [pair_weights(i, j, dR[e], dR[e]) for e in range(nmaps)]
+    if cross:
+        couples = [(e1, e2) for e1 in range(nmaps) \
+                       for e2 in range(e1 + 1, nmaps)]
+        weights += [pair_weights(i, j, dI[e1], dI[e2]) for e1, e2 in couples]
+        weights += [pair_weights(i, j, dR[e1], dR[e2]) for e1, e2 in couples]
+    return weights
+
+def csi_block_sums(i, j, _bin, dI, dR, nbins, cross=False):
+    """Returns the sums over a block of pairs (as returned by get_pairs),
+       for each theta bin, of:
+       - dI*dI for each of the Nmaps maps;
+       - the number of pairs;
+       - dR*dR for each of the Nmaps maps;
+       - (if cross) dI_1*dI_2 for each couple of maps (in the order
+         (0, 1), (0, 2), ..., (1, 2), ...), then dR_1*dR_2 in the same order.
+       With a single map this is the (3, Nbins) array (dI*dI, counts, dR*dR).
+
+       dI, dR: numpy array
+           a map or a (Nmaps, Npix) stack of maps sharing the same pixels
+    """
+    return np.array([np.bincount(_bin, weights=w, minlength=nbins) \
+                         for w in block_weights(i, j, dI, dR, cross)])
+
+def get_jk_regions(nside, pix, nside_jk):
+    """Returns the jackknife region of each of the given pixels, i.e. the
+       index (from 0 to Nreg-1) of the NSIDE=nside_jk superpixel containing
+       it, and the number Nreg of regions.
+
+       nside: int
+           healpix nside parameter of the maps
+       pix: numpy array
+           indices of the unmasked pixels (RING scheme)
+       nside_jk: int
+           nside of the superpixels (lower than nside)
+    """
+    if nside_jk >= nside:
+        abort('Jackknife NSIDE (%i) must be lower than NSIDE (%i)'\
+                  %(nside_jk, nside))
+    superpix = hp.ring2nest(nside, pix)//(nside/nside_jk)**2
+    _superpix, reg = np.unique(superpix, return_inverse=True)
+    return reg, len(_superpix)
+
+def region_block_sums(i, j, _bin, reg, nreg, dI, dR, nbins, cross=False):
+    """Returns the (Nreg, Nrows, Nbins) array with, for each jackknife
+       region, the sums of csi_block_sums restricted to the pairs with at
+       least one pixel in the region, i.e. the sums to be subtracted from
+       the total ones to get the leave-one-out estimates.
+
+       reg: numpy array
+           region of each pixel (indexed as dI, see get_jk_regions)
+       nreg: int
+           number of regions
+    """
+    ri, rj = reg[i], reg[j]
+    same = ri == rj
+    idx_i = ri*nbins + _bin
+    idx_j = rj*nbins + _bin
+    weights = block_weights(i, j, dI, dR, cross)
+    sums = np.zeros((nreg, len(weights), nbins))
+    for k, w in enumerate(weights):
+        s = np.bincount(idx_i, weights=w, minlength=nreg*nbins) + \
+            np.bincount(idx_j, weights=w, minlength=nreg*nbins) - \
+            np.bincount(idx_i[same], weights=w[same], minlength=nreg*nbins)
+        sums[:, k] = s.reshape(nreg, nbins)
+    return sums
+
+def jackknife_csi(sums, jk_sums, row, count_row):
+    """Returns the (Nreg, Nbins) array of the leave-one-out Csi estimates
+       and their (Nbins, Nbins) jackknife covariance matrix.
+
+       sums: numpy array
+           total sums, as returned by csi_block_sums
+       jk_sums: numpy array
+           sums over the pairs touching each region, as returned by
+           region_block_sums
+       row, count_row: int
+           rows of the sums of the products and of the counts
+    """
+    csi_jk = (sums[row] - jk_sums[:, row])/\
+        (sums[count_row] - jk_sums[:, count_row])
+    nreg = len(csi_jk)
+    dcsi = csi_jk - np.mean(csi_jk, axis=0)
+    cov = (nreg - 1.)/nreg*np.dot(dcsi.T, dcsi)
+    return csi_jk, cov
+
+def null_block_sums(i, j, _bin, null, nbins, null2=None):
+    """Returns the (Nperm, Nbins) array with the sums of the products of the
+       pixel values over a block of pairs, for each map of the null
+       ensemble returned by permute_ensemble.
+
+       null2: numpy array
+           values of a second map on the unmasked pixels: if given, each
+           map of the ensemble is cross-correlated with it
+    """
+    sums = np.zeros((len(null), nbins))
+    for k in range(0, len(null)):
+        if null2 is None:
+            sums[k] = pair_sum(i, j, _bin, null[k], null[k], nbins)
+        else:
+            sums[k] = pair_sum(i, j, _bin, null[k], null2, nbins)
+    return sums
+
+def permute_ensemble(values, nperm, seed):
+    """Returns a (Nperm, N) array with Nperm random permutations of the
+       values of the unmasked pixels.
+
+       All the permutations are generated at once (argsort of a matrix of
+       uniform random keys) from a single seed, so that the ensemble is
+       reproducible.
+    """
+    keys = np.random.RandomState(seed).random_sample((nperm, len(values)))
+    return np.asarray(values)[np.argsort(keys, axis=1)]
+
+def csi_pair_sums(xyz, dI, dR, th_bins, chunk_size=10000):
+    """Returns a (3, Nbins) array with the sums over the pixel pairs in each
+       theta bin of dI*dI, of the number of pairs and of dR*dR.
+
+       xyz: numpy array
+           (N, 3) array of unit vectors of the unmasked pixels
+       dI, dR: numpy array
+           values of the maps in the unmasked pixels (same order of xyz)
+       th_bins: numpy array
+           edges of the theta binning [rad]
+       chunk_size: int
+           number of pixels queried at once (it limits the memory usage)
+    """
+    nbins = len(th_bins) - 1
+    tree = build_pair_tree(xyz)
+    sums = np.zeros((3, nbins))
+    for start in range(0, len(xyz), chunk_size):
+        stop = min(start + chunk_size, len(xyz))
+        i, j, _bin = get_pairs(tree, xyz, th_bins, start, stop)
+        sums += csi_block_sums(i, j, _bin, dI, dR, nbins)
+        logger.info('%i/%i pixels done'%(stop, len(xyz)))
+    return sums
+
+def cl2csi(cl, th_bins):
+    """Returns the angular correlation function averaged (in solid angle)
+       over each theta bin, given the angular power spectrum.
+
+       The average of P_l(cos(th)) over a bin is obtained analytically from
+       the integral of the Legendre polynomials,
+       (2l+1) P_l = d/dx (P_{l+1} - P_{l-1}), and the P_l(x) are computed at
+       all the bin edges at once with the Bonnet recurrence.
+
+       cl: numpy array
+           angular power spectrum (from l=0)
+       th_bins: numpy array
+           edges of the theta binning [rad]
+    """
+    x = np.cos(np.asarray(th_bins, dtype=float))
+    p_prev = np.ones(len(x))
+    p_l = np.ones(len(x))
+    p_next = x.copy()
+    _int = np.zeros(len(x))
+    for l in range(0, len(cl)):
+        _int += cl[l]*(p_next - p_prev)
+        p_prev, p_l = p_l, p_next
+        p_next = ((2*l + 3)*x*p_l - (l + 1)*p_prev)/(l + 2)
+    return (_int[:-1] - _int[1:])/(4*np.pi*(x[:-1] - x[1:]))
+
+def csi_harmonic(dmap, mask, th_bins, lmax=None, dmap2=None):
+    """Returns the angular correlation function averaged over each theta bin
+       of a masked map, computed from its pseudo-Cl.
+
+       The pseudo-Cl is computed once with anafast and corrected for the
+       sky fraction (as in mkCl), so that the cost is the one of the
+       spherical harmonic transform instead of the one of the pair sum.
+
+       dmap: numpy array
+           healpix map of the fluctuations
+       mask: numpy array
+           healpix map of the mask (0 = masked pixel)
+       th_bins: numpy array
+           edges of the theta binning [rad]
+       lmax: int
+           maximum multipole (default 3*NSIDE-1)
+       dmap2: numpy array
+           second map, to get the cross-correlation function (optional)
+    """
+    _mask = np.asarray(mask) != 0
+    fsky = np.sum(_mask)/float(len(_mask))
+    _map = np.where(_mask, dmap, 0.)
+    if dmap2 is not None:
+        _map2 = np.where(_mask, dmap2, 0.)
+        _cl = hp.sphtfunc.anafast(_map, _map2, lmax=lmax, iter=3)
+    else:
+        _cl = hp.sphtfunc.anafast(_map, lmax=lmax, iter=3)
+    return cl2csi(_cl/fsky, th_bins)
+
+
+def main():
+    """Test module
+    """
+    nside = 64
+    th_bins = np.array([0., 0.01, 0.02, 0.05, 0.1])
+    pix = np.arange(hp.nside2npix(nside))
+    xyz = pix2xyz(nside, pix)
+    dI = np.random.normal(size=len(pix))
+    print(csi_pair_sums(xyz, dI, dI, th_bins))
+
+
+if __name__ == '__main__':
+    main()
@@ -38,122 +38,35 @@ def flux2counts(flux_map, exposure_map):
 
 def fit_foreground(fore_map, data_map):
     """ATT: maps are intended to be healpix maps (namely numpy arrays)
+
+       Returns the normalization of the foreground map and the constant
+       fitted to the data map (see ForegroundFitter.fit; the mask and the
+       downgrade operator are kept between the calls).
     """
-    nside_out = 64
-    _notnull = np.where(data_map > 1e-30)[0]
-    mask_f = os.path.join(GRATOOLS_CONFIG, 'fits/Mask64_src2_gp30.fits')
-    mask = hp.read_map(mask_f)
-    _unmask = np.where(mask > 1e-30)[0]
-    logger.info('down grade...')
-    fore_repix = np.array(hp.ud_grade(fore_map, nside_out=nside_out))
-    data_repix =  np.array(hp.ud_grade(data_map, nside_out=nside_out))   
-    A = np.vstack([fore_repix[_unmask], np.ones(len(fore_repix[_unmask]))]).T
-    norm, const = np.linalg.lstsq(A, data_repix[_unmask])[0]
-    #a, norm = best_fit(fore_map[_notnull], data_map[_notnull])
-    logger.info('fit param (norm, const): %.3f, %e' %(norm, const))
+    from GRATools.utils.gForeFit import get_foreground_fitter
+    fitter = get_foreground_fitter()
+    (norm, const), cov = [x[0] for x in fitter.fit(fore_map, data_map)]
+    norm_err, const_err = np.sqrt(np.diag(cov))
+    logger.info('fit param (norm, const): %.3f +- %.3f, %e +- %e' \
+                    %(norm, norm_err, const, const_err))
     return norm, const
 
 def get_foreground_integral_flux_map(fore_files_list, e_min, e_max):
-    """fore_files_list: list of str
+    """Returns the integral flux map of the foreground model between e_min
+       and e_max (see ForegroundCube.integral_flux).
+
+       fore_files_list: list of str
            Ordered list of the foreground files (one for each energy)
        e_min: float
            the min of the energy bin
        e_max: float 
            the max of the energy bin
     """
-    input_file = os.path.join(FT_DATA_FOLDER, 'models/gll_iem_v06.fits')
-    if not os.path.exists(input_file):
-        abort("Map %s not found!"%input_file)
-    frmaps = pf.open(input_file)
-    fore_en = np.array([x[0] for x in frmaps['ENERGIES'].data])
-    out_name = fore_files_list[0].replace('_%i.fits'%int(fore_en[0]), 
-                                          '_%d-%d.fits'%(e_min, e_max))
-    if os.path.exists(out_name):
-        logger.info('ATT: file %s already exists and returned...'%out_name)
-        fore_map = hp.read_map(out_name)
-        return fore_map
-    else: 
-        logger.info('Computing the integral flux of the foreground model...')
-        logger.info('...between %.2f - %.2f'%(e_min, e_max))
-        if (fore_en < e_max).any() and (fore_en > e_min).any():
-            if fore_en[(fore_en < e_max)&(fore_en > e_min)].size == 0:
-                if (fore_en < e_max).all():
-                    print 'no foreground model for e_max'
-                    if (fore_en < e_min).all():
-                        print 'no foreground model for e_min'
-                        fore_map1 = hp.read_map(fore_files_list[-2])
-                        fore_map2 = hp.read_map(fore_files_list[-1])
-                        fore_e_min = fore_en[-2]
-                        fore_e_max = fore_en[-1]
-                    else:
-                        fore_map2 = hp.read_map(fore_files_list[np.where(\
-                                    fore_en<e_max)[0][-1]])
-                        fore_e_max = fore_en[np.where(fore_en<e_max)[0][-1]]
-                        fore_map1 = hp.read_map(fore_files_list[np.where(\
-                                    fore_en<e_min)[0][-1]])
-                        fore_e_min = fore_en[np.where(fore_en<e_min)[0][-1]]
-                else:
-                    fore_map1 = hp.read_map(fore_files_list[np.where(\
-                                fore_en<e_min)[0][-1]])
-                    fore_map2 = hp.read_map(fore_files_list[np.where(\
-                                fore_en>e_max)[0][0]])
-                    fore_e_max = fore_en[np.where(fore_en>e_max)[0][0]]
-                    fore_e_min = fore_en[np.where(fore_en<e_min)[0][-1]]
-            else:
-                e_int = fore_en[(fore_en < e_max)&(fore_en > e_min)]
-                index = np.where(fore_en==e_int)[0]
-                if abs(e_min-e_int) <= abs(e_max-e_int):
-                    a = index-1
-                    fore_e_min = fore_en[a]
-                    fore_e_max = fore_en[index]
-                    fore_map1 = hp.read_map(fore_files_list[a])
-                    fore_map2 = hp.read_map(fore_files_list[index])
-                else:
-                    a = index+1
-                    if a > 29:
-                        a = index-1
-                        fore_e_min = fore_en[a]
-                        fore_e_max = fore_en[index]
-                        fore_map1 = hp.read_map(fore_files_list[a])
-                        fore_map2 = hp.read_map(fore_files_list[index])
-                    else:
-                        fore_e_min = fore_en[index]
-                        fore_e_max = fore_en[a]
-                        fore_map1 = hp.read_map(fore_files_list[index])
-                        fore_map2 = hp.read_map(fore_files_list[a])
-        elif (fore_en < e_max).all():
-            print 'no foreground model for e_max'
-            if (fore_en < e_min).all():
-                print 'no foreground model for e_min'
-                fore_map1 = hp.read_map(fore_files_list[-2])
-                fore_map2 = hp.read_map(fore_files_list[-1])
-                fore_e_min = fore_en[-2] 
-                fore_e_max = fore_en[-1]
-            else:
-                fore_map2 = hp.read_map(fore_files_list[np.where(\
-                            fore_en<e_max)[0][-1]])
-                fore_e_max = fore_en[np.where(fore_en<e_max)[0][-1]] 
-                fore_map1 = hp.read_map(fore_files_list[np.where(\
-                            fore_en<e_min)[0][-1]])
-                fore_e_min = fore_en[np.where(fore_en<e_min)[0][-1]]
-        else:
-            fore_map1 = hp.read_map(fore_files_list[np.where(\
-                        fore_en<e_min)[0][-1]])
-            fore_map2 = hp.read_map(fore_files_list[np.where(\
-                        fore_en>e_max)[0][0]])
-            fore_e_max = fore_en[np.where(fore_en>e_max)[0][0]]
-            fore_e_min = fore_en[np.where(fore_en<e_min)[0][-1]]
-        logger.info('getting foreground between %.2f - %.2f'\
-                        %(fore_e_min, fore_e_max))
-        A = (fore_map2 - fore_map1)/(fore_e_max - fore_e_min)
-        B = fore_map1 - fore_e_min*A
-        #fore_integr = (A/2*(e_max**2-e_min**2)+B*(e_max-e_min))
-        #print 'e mean:', np.sqrt((e_max*e_min)), 'delta E:', e_max-e_min
-        fore_integr1 = (A*e_max + B)
-        fore_integr2 = (A*e_min + B)
-        fore_integr = np.sqrt(fore_integr1*fore_integr2)*(e_max-e_min)
-        hp.write_map(out_name, fore_integr)
-        return fore_integr
+    from GRATools.utils.gForeCube import ForegroundCube
+    logger.info('Computing the integral flux of the foreground model...')
+    logger.info('...between %.2f - %.2f'%(e_min, e_max))
+    fore_cube = ForegroundCube(fore_files_list)
+    return fore_cube.integral_flux([(e_min, e_max)])[0]
 
 def csi_parse(csi_file):
     """Parsing of the *_csi.txt files
@@ -182,6 +95,40 @@ def csi_parse(csi_file):
     f.close()
     return np.array(emin), np.array(emax), np.array(emean), np.array(csi), np.array(theta), np.array(Rs)
 
+def csi_null_parse(csi_file):
+    """Parsing of the null distribution (R_MEAN and R_COV rows) in the 
+       *_csi.txt files
+    """
+    logger.info('loading null Csi distribution from %s'%csi_file)
+    r_mean, r_cov = [], []
+    f = open(csi_file, 'r')
+    for line in f:
+        if 'R_MEAN\t' in line:
+            rm = np.array([float(item) for item in line.split()[1:]])
+            r_mean.append(rm)
+        if 'R_COV\t' in line:
+            rc = np.array([float(item) for item in line.split()[1:]])
+            nth = int(np.sqrt(len(rc)))
+            r_cov.append(rc.reshape(nth, nth))
+    f.close()
+    return np.array(r_mean), np.array(r_cov)
+
+def csi_cov_parse(csi_file):
+    """Parsing of the jackknife covariance (CSI_COV rows) in the *_csi.txt
+       files. Returns the Csi errors and covariance matrices.
+    """
+    logger.info('loading Csi covariance from %s'%csi_file)
+    csi_err, csi_cov = [], []
+    f = open(csi_file, 'r')
+    for line in f:
+        if 'CSI_COV\t' in line:
+            cc = np.array([float(item) for item in line.split()[1:]])
+            nth = int(np.sqrt(len(cc)))
+            csi_cov.append(cc.reshape(nth, nth))
+            csi_err.append(np.sqrt(np.diag(csi_cov[-1])))
+    f.close()
+    return np.array(csi_err), np.array(csi_cov)
+
 def cp_parse(cp_file):
     """Parsing of the *_cps.txt files
     """
@@ -232,6 +179,35 @@ def clEcross_parse(cl_file):
         np.array(_emin2), np.array(_emax2),np.array(_emean2), \
         np.array(_cls), np.array(_clserr)
 
+def csiEcross_parse(csi_file):
+    """Parsing of the *_csiEcross.txt files
+    """
+    logger.info('loading Csi values from %s'%csi_file)
+    ff = open(csi_file, 'r')
+    _emin1, _emax1, _emean1, _emin2, _emax2, _emean2 = [], [], [], [], [], []
+    _th, _csi, _r = [], [], []
+    for line in ff:
+        if 'ENERGY1\t' in line:
+            emin1, emax1, emean1 = [float(item) for item in line.split()[1:]]
+            _emin1.append(emin1)
+            _emax1.append(emax1)
+            _emean1.append(emean1)
+        if 'ENERGY2\t' in line:
+            emin2, emax2, emean2 = [float(item) for item in line.split()[1:]]
+            _emin2.append(emin2)
+            _emax2.append(emax2)
+            _emean2.append(emean2)
+        if 'THETA\t' in line:
+            _th.append(np.array([float(item) for item in line.split()[1:]]))
+        if 'CSI\t' in line:
+            _csi.append(np.array([float(item) for item in line.split()[1:]]))
+        if 'R\t' in line:
+            _r.append(np.array([float(item) for item in line.split()[1:]]))
+    ff.close()
+    return np.array(_emin1), np.array(_emax1),np.array(_emean1), \
+        np.array(_emin2), np.array(_emax2),np.array(_emean2), \
+        np.array(_th), np.array(_csi), np.array(_r)
+
 def clfore_parse(clfore_file):
     """Parsing of the *_forecls.txt files.
     """
@@ -0,0 +1,207 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+# On behalf of the Fermi-LAT Collaboration.                                    #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Cube of the energy planes of the foreground model
+"""
+
+
+import os
+import re
+import json
+import numpy as np
+import healpy as hp
+import pyfits as pf
+from GRATools import FT_DATA_FOLDER
+from GRATools.utils.logging_ import logger, abort
+
+FORE_MODEL_FILE = os.path.join(FT_DATA_FOLDER, 'models/gll_iem_v06.fits')
+LOG_FLUX_MIN = np.log(1e-30)
+
+
+def get_inputs_signature(fore_files_list):
+    """Returns the list of the [path, size, modification time] of the input
+       files of a cube, stored next to it to detect when they change.
+    """
+    signature = []
+    for fore_file in fore_files_list:
+        if not os.path.exists(fore_file):
+            abort("Map %s not found!"%fore_file)
+        stat = os.stat(fore_file)
+        signature.append([os.path.abspath(fore_file), stat.st_size,
+                          stat.st_mtime])
+    return signature
+
+def read_inputs_signature(inputs_file):
+    """Returns the signature stored in inputs_file (None if missing).
+    """
+    if not os.path.exists(inputs_file):
+        return None
+    f = open(inputs_file, 'r')
+    signature = json.load(f)
+    f.close()
+    return signature
+
+
+class ForegroundCube(object):
+
+    """Healpix maps of the differential flux of the foreground model at each
+    energy of the model, stacked in a (Nenergies, Npix) array of the log of
+    the flux.
+    The cube is built once from the healpix maps of the energy planes (see
+    mkforeground.py) and cached in a .npy file next to them, which is then
+    memory-mapped; it is rebuilt if the size or the modification time of
+    the input files changed.
+    Args
+    ----
+    fore_files_list : list of str
+        Ordered list of the foreground files (one for each energy), or the
+        multi-field healpix cube written by mkforeground.py (a single file,
+        with the ENERGIES extension).
+    """
+
+    def __init__(self, fore_files_list):
+        """Constructor.
+        """
+        if isinstance(fore_files_list, str):
+            fore_files_list = [fore_files_list]
+        cube_file = re.sub('(_\d+)?\.fits$', '_logcube.npy',
+                           fore_files_list[0])
+        en_file = cube_file.replace('.npy', '_energies.npy')
+        inputs_file = cube_file.replace('.npy', '_inputs.json')
+        inputs = get_inputs_signature(fore_files_list)
+        if not os.path.exists(cube_file) or not os.path.exists(en_file):
+            self.build(fore_files_list, cube_file, en_file, inputs_file)
+        elif read_inputs_signature(inputs_file) != inputs:
+            logger.info('Foreground files changed: rebuilding the cube...')
+            self.build(fore_files_list, cube_file, en_file, inputs_file)
+        else:
+            logger.info('Using the foreground cube %s'%cube_file)
+        self.log_flux = np.load(cube_file, mmap_mode='r')
+        self.energies = np.load(en_file)
+        self.log_en = np.log(self.energies)
+        self.nside = hp.npix2nside(self.log_flux.shape[1])
+
+    @staticmethod
+    def build(fore_files_list, cube_file, en_file, inputs_file):
+        """Reads each energy plane once and writes the cube files.
+        """
+        if len(fore_files_list) == 1:
+            # multi-field cube: one field for each energy
+            en_source = fore_files_list[0]
+        else:
+            en_source = FORE_MODEL_FILE
+        if not os.path.exists(en_source):
+            abort("Map %s not found!"%en_source)
+        frmaps = pf.open(en_source)
+        energies = np.array([x[0] for x in frmaps['ENERGIES'].data])
+        frmaps.close()
+        if len(fore_files_list) == 1:
+            planes = [(fore_files_list[0], i) for i in range(len(energies))]
+        else:
+            if len(energies) != len(fore_files_list):
+                abort('%i foreground files for %i energies'\
+                          %(len(fore_files_list), len(energies)))
+            planes = [(fore_file, 0) for fore_file in fore_files_list]
+        logger.info('Building the foreground cube %s...'%cube_file)
+        for i, (fore_file, field) in enumerate(planes):
+            fore_map = hp.read_map(fore_file, field=field)
+            if i == 0:
+                cube = np.lib.format.open_memmap(cube_file + '_tmp', mode='w+',
+                                                 dtype=np.float32,
+                                                 shape=(len(energies),
+                                                        len(fore_map)))
+            with np.errstate(divide='ignore'):
+                cube[i] = np.maximum(np.log(fore_map), LOG_FLUX_MIN)
+        cube.flush()
+        del cube
+        np.save(en_file, energies)
+        os.rename(cube_file + '_tmp', cube_file)
+        f = open(inputs_file, 'w')
+        json.dump(get_inputs_signature(fore_files_list), f)
+        f.close()
+
+    def integral_flux(self, e_bins):
+        """Returns the (Nbins, Npix) array of the integral flux maps of the
+        foreground model in the given energy bins.
+
+        The differential flux is interpolated between the energy planes of
+        the model as a power law in each pixel (linear in log-log, and
+        extrapolated with the first and last pair of planes outside of the
+        energy range) and integrated analytically, so that each plane is
+        read once for all the bins.
+
+        e_bins: list
+            list of the (e_min, e_max) energy bins
+        """
+        e_min, e_max = np.array(e_bins, dtype=float).T
+        nseg = len(self.energies) - 1
+        seg_min = np.clip(np.searchsorted(self.energies, e_min) - 1, 0,
+                          nseg - 1)
+        seg_max = np.clip(np.searchsorted(self.energies, e_max) - 1, 0,
+                          nseg - 1)
+        fore_integr = np.zeros((len(e_min), self.log_flux.shape[1]))
+        for k in range(seg_min.min(), seg_max.max() + 1):
+            _bins = np.where((seg_min <= k)&(seg_max >= k))[0]
+            if len(_bins) == 0:
+                continue
+            logger.info('Integrating the foreground between %.2f - %.2f...'\
+                            %(self.energies[k], self.energies[k+1]))
+            log_f1 = np.array(self.log_flux[k], dtype=np.float64)
+            log_f2 = np.array(self.log_flux[k+1], dtype=np.float64)
+            index = (log_f2 - log_f1)/(self.log_en[k+1] - self.log_en[k]) + 1.
+            # limits of the segment in each bin, in log(E/E_k)
+            u = np.log(np.where(seg_min[_bins] == k, e_min[_bins],
+                                self.energies[k])/self.energies[k])
+            v = np.log(np.where(seg_max[_bins] == k, e_max[_bins],
+                                self.energies[k+1])/self.energies[k])
+            # integral of E_k*exp((index)*x) between u and v
+            iu = np.outer(u, index)
+            dx = np.outer(v - u, index)
+            _flat = np.abs(index) < 1e-8
+            index[_flat] = 1.
+            with np.errstate(over='ignore', invalid='ignore'):
+                integr = np.exp(iu)*np.expm1(dx)/index
+            integr[:, _flat] = (v - u)[:, np.newaxis]
+            fore_integr[_bins] += np.exp(log_f1)*self.energies[k]*integr
+        return fore_integr
+
+
+def main():
+    """Test module
+    """
+    import tempfile
+    nside = 4
+    energies = np.array([100., 1000., 10000.])
+    tmp_dir = tempfile.mkdtemp()
+    fore_files_list = []
+    for en in energies:
+        fore_files_list.append(os.path.join(tmp_dir, 'fore_%i.fits'%en))
+        hp.write_map(fore_files_list[-1],
+                     np.full(hp.nside2npix(nside), en**-2.))
+    cube_file = os.path.join(tmp_dir, 'fore_logcube.npy')
+    np.save(cube_file.replace('.npy', '_energies.npy'), energies)
+    cube = np.lib.format.open_memmap(cube_file, mode='w+', dtype=np.float32,
+                                     shape=(3, hp.nside2npix(nside)))
+    cube[:] = np.log([[m] for m in energies**-2.])
+    del cube
+    f = open(cube_file.replace('.npy', '_inputs.json'), 'w')
+    json.dump(get_inputs_signature(fore_files_list), f)
+    f.close()
+    fore_cube = ForegroundCube(fore_files_list)
+    e_bins = [(200., 500.), (500., 5000.), (5000., 50000.)]
+    print(fore_cube.integral_flux(e_bins)[:, 0],
+          [1./e1 - 1./e2 for e1, e2 in e_bins])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+# On behalf of the Fermi-LAT Collaboration.                                    #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Template fit of the foreground (and other) components to the data maps
+"""
+
+
+import os
+import numpy as np
+import healpy as hp
+from scipy import sparse
+from GRATools import GRATOOLS_CONFIG
+from GRATools.utils.logging_ import logger, abort
+from GRATools.utils.gMaskCache import get_mask
+
+FIT_MASK_FILE = os.path.join(GRATOOLS_CONFIG, 'fits/Mask64_src2_gp30.fits')
+FORE_FITTERS = {}
+
+
+def get_foreground_fitter(mask_file=FIT_MASK_FILE, nside_out=64):
+    """Returns the ForegroundFitter with the given mask and NSIDE (created
+       only at the first call, then shared).
+    """
+    key = (mask_file, nside_out)
+    if key not in FORE_FITTERS:
+        FORE_FITTERS[key] = ForegroundFitter(mask_file, nside_out)
+    return FORE_FITTERS[key]
+
+
+class ForegroundFitter(object):
+
+    """Fits a stack of templates (e.g. several diffuse components, the
+    isotropic emission, a point-source template), plus optionally a
+    constant, to a batch of data maps (e.g. all the macro energy bins) at
+    once, in the unmasked pixels of a low resolution map.
+    The mask and the operators bringing the maps to nside_out (one for each
+    input NSIDE) are computed once and kept.
+    Args
+    ----
+    mask_file : str
+        Fits file of the mask used in the fit.
+    nside_out : int
+        Healpix nside parameter at which the fit is done.
+    """
+
+    def __init__(self, mask_file=FIT_MASK_FILE, nside_out=64):
+        """Constructor.
+        """
+        self.mask_file = mask_file
+        self.nside_out = nside_out
+        self._unmask = None
+        self._operators = {}
+
+    def unmask(self):
+        """Returns the unmasked pixels of the mask at nside_out.
+        """
+        if self._unmask is None:
+            mask = get_mask(self.mask_file).downgrade(self.nside_out)
+            self._unmask = np.where(mask > 1e-30)[0]
+        return self._unmask
+
+    def operator(self, nside_in):
+        """Returns the sparse (Npix_out, Npix_in) matrix summing the pixels
+           at nside_in into the ones at nside_out (or, if nside_in is
+           smaller, copying each pixel into its sub-pixels).
+        """
+        if nside_in not in self._operators:
+            logger.info('Building the NSIDE %i -> %i operator...'\
+                            %(nside_in, self.nside_out))
+            npix_in = hp.nside2npix(nside_in)
+            npix_out = hp.nside2npix(self.nside_out)
+            if nside_in >= self.nside_out:
+                ratio = (nside_in/self.nside_out)**2
+                pix_in = np.arange(npix_in)
+                pix_out = hp.nest2ring(self.nside_out,
+                                       hp.ring2nest(nside_in, pix_in)/ratio)
+            else:
+                ratio = (self.nside_out/nside_in)**2
+                pix_out = np.arange(npix_out)
+                pix_in = hp.nest2ring(nside_in,
+                                      hp.ring2nest(self.nside_out,
+                                                   pix_out)/ratio)
+            self._operators[nside_in] = \
+                sparse.csr_matrix((np.ones(len(pix_in)), (pix_out, pix_in)),
+                                  shape=(npix_out, npix_in))
+        return self._operators[nside_in]
+
+    def downgrade(self, maps, sum_pixels=False):
+        """Returns the (N, Npix_out) array of the maps at nside_out, i.e.
+           the mean of the values of the sub-pixels (as hp.ud_grade), or
+           their sum if sum_pixels (for counts maps). The hp.UNSEEN pixels
+           are ignored; the output pixels without valid sub-pixels are set
+           to hp.UNSEEN.
+
+           maps: numpy array
+               (N, Npix) array of maps sharing the same NSIDE
+        """
+        maps = np.atleast_2d(maps)
+        npix_in = maps.shape[1]
+        op = self.operator(hp.npix2nside(npix_in))
+        valid = (maps != hp.UNSEEN).T
+        nvalid = np.asarray(op.dot(valid.astype(float)))
+        sums = np.asarray(op.dot(np.where(valid, maps.T, 0.)))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = sums/nvalid
+        if sum_pixels:
+            out *= float(npix_in)/op.shape[0]
+        out[nvalid == 0] = hp.UNSEEN
+        return out.T
+
+    def design(self, templates, data, const, sum_pixels):
+        """Returns the (Nbins, Npar, Npix_fit) design arrays and the
+           (Nbins, Npix_fit) data arrays in the pixels used in the fit
+           (unmasked and valid in all the maps).
+        """
+        data = np.atleast_2d(data)
+        nbins, npix = data.shape
+        templates = np.asarray(templates)
+        if templates.ndim == 1:
+            templates = templates[np.newaxis]
+        if templates.ndim == 2:
+            templates = np.tile(templates, (nbins, 1, 1))
+        ntemp = templates.shape[1]
+        data_repix = self.downgrade(data, sum_pixels)
+        tmpl_repix = self.downgrade(templates.reshape(-1, npix), sum_pixels)
+        tmpl_repix = tmpl_repix.reshape(nbins, ntemp, -1)
+        _fit = self.unmask()
+        _valid = (data_repix[:, _fit] != hp.UNSEEN).all(axis=0)
+        _valid &= (tmpl_repix[:, :, _fit] != hp.UNSEEN).all(axis=(0, 1))
+        _fit = _fit[_valid]
+        A = tmpl_repix[:, :, _fit]
+        if const:
+            A = np.concatenate((A, np.ones((nbins, 1, len(_fit)))), axis=1)
+        return A, data_repix[:, _fit]
+
+    def fit(self, templates, data, const=True, method='lstsq', niter=50,
+            tol=1e-8):
+        """Returns the (Nbins, Npar) array of the best-fit normalizations of
+           the templates (followed by the constant, if const) for each data
+           map, and the (Nbins, Npar, Npar) array of their covariance.
+
+           All the data maps are fitted at once:
+           - 'lstsq': least squares (normal equations), with the covariance
+             scaled by the variance of the residuals;
+           - 'poisson': Poisson likelihood maximized with Newton iterations,
+             with the covariance from the Fisher matrix. Data and templates
+             must be counts maps (summed when downgraded).
+
+           templates: numpy array
+               (Ntemp, Npix) stack of templates common to all the data maps
+               or (Nbins, Ntemp, Npix) array with the stack of each map
+           data: numpy array
+               (Nbins, Npix) array of the data maps (or a single map)
+        """
+        if method not in ['lstsq', 'poisson']:
+            abort('Unknown fit method %s'%method)
+        A, y = self.design(templates, data, const, method == 'poisson')
+        nbins, npar, npix = A.shape
+        # columns scaled to unit norm to keep the normal matrix conditioned
+        scale = np.sqrt(np.einsum('bkp,bkp->bk', A, A))
+        scale[scale == 0] = 1.
+        A = A/scale[:, :, np.newaxis]
+        ATA = np.einsum('bkp,blp->bkl', A, A)
+        x = np.linalg.solve(ATA, np.einsum('bkp,bp->bk', A, y))
+        if method == 'lstsq':
+            res = y - np.einsum('bkp,bk->bp', A, x)
+            var = np.einsum('bp,bp->b', res, res)/max(npix - npar, 1)
+            cov = np.linalg.inv(ATA)*var[:, np.newaxis, np.newaxis]
+        else:
+            mu = np.einsum('bkp,bk->bp', A, x)
+            _bad = (mu <= 0).any(axis=1)
+            # if the linear solution is not positive start from a flat model
+            x[_bad] = (y[_bad].sum(axis=1)/A[_bad].sum(axis=2).sum(axis=1))\
+                [:, np.newaxis]*np.ones(npar)
+            for it in range(0, niter):
+                mu = np.einsum('bkp,bk->bp', A, x)
+                grad = np.einsum('bkp,bp->bk', A, y/mu - 1.)
+                hess = np.einsum('bkp,blp,bp->bkl', A, A, y/mu**2)
+                hess += 1e-12*np.eye(npar)
+                dx = np.linalg.solve(hess, grad)
+                dmu = np.einsum('bkp,bk->bp', A, dx)
+                step = np.ones(nbins)
+                for k in range(0, 50):
+                    _bad = (mu + step[:, np.newaxis]*dmu <= 0).any(axis=1)
+                    if not _bad.any():
+                        break
+                    step[_bad] *= 0.5
+                x += step[:, np.newaxis]*dx
+                if np.max(np.abs(step[:, np.newaxis]*dx)/\
+                              (np.abs(x) + 1e-30)) < tol:
+                    break
+            mu = np.einsum('bkp,bk->bp', A, x)
+            cov = np.linalg.inv(np.einsum('bkp,blp,bp->bkl', A, A, 1./mu))
+        x = x/scale
+        cov = cov/(scale[:, :, np.newaxis]*scale[:, np.newaxis, :])
+        return x, cov
+
+
+def main():
+    """Test module
+    """
+    nside = 32
+    npix = hp.nside2npix(nside)
+    fitter = ForegroundFitter(nside_out=8)
+    fitter._unmask = np.arange(hp.nside2npix(8))
+    rs = np.random.RandomState(0)
+    templates = rs.uniform(1, 2, (2, npix))
+    model = np.array([[3., 1.], [5., 2.]]).dot(templates) + 4.
+    print(fitter.fit(templates, model + rs.normal(0, 0.1, (2, npix)))[0])
+    print(fitter.fit(templates, rs.poisson(model), method='poisson')[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+# On behalf of the Fermi-LAT Collaboration.                                    #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Masks read once per process and shared by all the pipeline stages
+"""
+
+
+import os
+import hashlib
+import numpy as np
+import healpy as hp
+import pyfits as pf
+from GRATools.utils.logging_ import logger, abort
+
+MASKS = {}
+MASK_HASHES = {}
+
+
+def get_file_hash(mask_file):
+    """Returns the md5 hash of the content of a file (computed once for each
+       version of the file, identified by its path, size and modification
+       time).
+    """
+    if not os.path.exists(mask_file):
+        abort("Map %s not found!"%mask_file)
+    stat = os.stat(mask_file)
+    key = (os.path.abspath(mask_file), stat.st_size, stat.st_mtime)
+    if key not in MASK_HASHES:
+        md5 = hashlib.md5()
+        f = open(mask_file, 'rb')
+        for block in iter(lambda: f.read(2**20), b''):
+            md5.update(block)
+        f.close()
+        MASK_HASHES[key] = md5.hexdigest()
+    return MASK_HASHES[key]
+
+def get_mask(mask_file, field=None):
+    """Returns the SkyMask of a mask file, read only at the first call: the
+       masks are cached by the hash of the file content, so that copies of
+       the same file are also read once.
+
+       mask_file: str or tuple
+           fits file of the mask, or (file, field) tuple (as in the
+           MASK_FILE entries of the config files)
+       field: int
+           field of the mask in the file (e.g. the energy of a multi-energy
+           mask written by mkmask.py); it must be given for those files,
+           otherwise the first field is read
+    """
+    if isinstance(mask_file, tuple):
+        mask_file, field = mask_file
+    key = (get_file_hash(mask_file), field)
+    if key not in MASKS:
+        if field is None:
+            hdulist = pf.open(mask_file)
+            multi = 'ENERGIES' in [hdu.name for hdu in hdulist]
+            hdulist.close()
+            if multi:
+                abort('%s has one mask for each energy: give (file, field)'\
+                          %mask_file)
+        logger.info('Reading the mask %s...'%mask_file)
+        MASKS[key] = SkyMask(hp.read_map(mask_file, field=field or 0))
+    return MASKS[key]
+
+
+class SkyMask(object):
+
+    """Healpix mask stored as a packed bitset of the unmasked (non-zero)
+    pixels, with the array of their indices and the fsky; the values of the
+    unmasked pixels are kept only if the mask is not binary.
+    The products derived from the mask (e.g. the downgraded masks or the
+    mask of the masked maps) are computed once and kept.
+    Args
+    ----
+    mask_map : array
+        Healpix map of the mask (0 in the masked pixels).
+    """
+
+    def __init__(self, mask_map):
+        """Constructor.
+        """
+        mask_map = np.asarray(mask_map, dtype=np.float64)
+        self.npix = len(mask_map)
+        self.nside = hp.npix2nside(self.npix)
+        unmasked = mask_map != 0
+        self.bits = np.packbits(unmasked)
+        self.unmask = np.where(unmasked)[0]
+        self.fsky = len(self.unmask)/float(self.npix)
+        self.values = None
+        if not np.all(mask_map[self.unmask] == 1):
+            self.values = mask_map[self.unmask]
+        self._derived = {}
+
+    def derived(self, key, func, *args):
+        """Returns the product func(*args) of the mask, computed only at the
+           first call with the given key.
+        """
+        if key not in self._derived:
+            self._derived[key] = func(*args)
+        return self._derived[key]
+
+    def unmasked(self):
+        """Returns the boolean array of the unmasked pixels.
+        """
+        return np.unpackbits(self.bits)[:self.npix].astype(bool)
+
+    def ma_mask(self):
+        """Returns the boolean array of the masked pixels, to be used as the
+           mask of the maps returned by hp.ma (shared: not to be modified).
+        """
+        return self.derived('ma_mask',
+                            lambda: np.logical_not(self.unmasked()))
+
+    def to_map(self):
+        """Returns the healpix map of the mask.
+        """
+        mask_map = np.zeros(self.npix)
+        mask_map[self.unmask] = 1. if self.values is None else self.values
+        return mask_map
+
+    def downgrade(self, nside_out):
+        """Returns the mask at nside_out (as hp.ud_grade, i.e. the mean of
+           the sub-pixels), computed once for each NSIDE.
+        """
+        if nside_out == self.nside:
+            return self.derived('map', self.to_map)
+        return self.derived(('ud_grade', nside_out),
+                            lambda: hp.ud_grade(self.to_map(),
+                                                nside_out=nside_out))
+
+    def apodized(self, aposize, apotype='C1'):
+        """Returns the apodized mask (see gMasks.apodize_mask), computed once
+           for each scale and taper.
+
+           aposize: float
+               apodization scale (deg)
+           apotype: str
+               apodization taper ('C1', 'C2' or 'gaussian')
+        """
+        from GRATools.utils.gMasks import apodize_mask
+        return self.derived(('apodized', aposize, apotype),
+                            lambda: apodize_mask(self.to_map(), aposize,
+                                                 apotype))
+
+
+def main():
+    """Test module
+    """
+    import tempfile
+    mask_map = np.zeros(hp.nside2npix(8))
+    mask_map[100:300] = 1.
+    mask_file = os.path.join(tempfile.mkdtemp(), 'mask.fits')
+    hp.write_map(mask_file, mask_map)
+    mask = get_mask(mask_file)
+    print(mask.fsky, get_mask(mask_file) is mask,
+          np.array_equal(mask.to_map(), mask_map), mask.downgrade(4)[20:30])
+
+
+if __name__ == '__main__':
+    main()
@@ -24,9 +24,72 @@ from GRATools.utils.logging_ import logger, abort
 from GRATools.utils.matplotlib_ import pyplot as plt
 
 
+PIX_LONLAT = {}
+
+
+def get_pix_lonlat(NSIDE):
+    """Returns the galactic longitude (from -180 to 180 deg) and latitude of
+       the centres of all the pixels (computed once for each NSIDE).
+
+       NSIDE: int
+           healpix nside parameter
+    """
+    if NSIDE not in PIX_LONLAT:
+        x, y, z = hp.pix2vec(NSIDE, np.arange(hp.nside2npix(NSIDE)))
+        PIX_LONLAT[NSIDE] = hp.rotator.vec2dir(x, y, z, lonlat=True)
+    return PIX_LONLAT[NSIDE]
+
+def bad_pix2bool(bad_pix, NSIDE):
+    """Returns the boolean array (True for the 'bad pixels') of a list of
+       pixels.
+    """
+    bad = np.zeros(hp.nside2npix(NSIDE), dtype=bool)
+    bad[np.asarray(bad_pix, dtype=np.int64)] = True
+    return bad
+
+def mask_discs(GLON, GLAT, RADrad, NSIDE):
+    """Returns the boolean array of the 'bad pixels' within the given radius
+       from each of the given positions (pixels with the centre in the disc,
+       plus the pixel containing the position).
+
+       The pixels of each disc are written straight into the boolean array,
+       without collecting them in a list.
+       If several sets of radii are given (e.g. one for each energy), the
+       (Nsets, Npix) array of the masks is returned: each disc is queried
+       once, with its largest radius, and its pixels are then selected with
+       each of its radii.
+
+       GLON, GLAT: numpy array
+           galactic coordinates (deg) of the centres of the discs
+       RADrad: numpy array or float
+           radius (rad) of each disc, or (Nsets, Ndiscs) array of radii
+       NSIDE: int
+           healpix nside parameter
+    """
+    xyz = np.array(hp.rotator.dir2vec(np.asarray(GLON, dtype=float),
+                                      np.asarray(GLAT, dtype=float),
+                                      lonlat=True)).reshape(3, -1).T
+    RADrad = np.asarray(RADrad, dtype=float)*np.ones(len(xyz))
+    _rad = np.atleast_2d(RADrad)
+    bad = np.zeros((len(_rad), hp.nside2npix(NSIDE)), dtype=bool)
+    bad[:, hp.vec2pix(NSIDE, xyz[:, 0], xyz[:, 1], xyz[:, 2])] = True
+    if len(_rad) == 1:
+        for vec, rad in zip(xyz, _rad[0]):
+            bad[0, hp.query_disc(NSIDE, vec, rad)] = True
+    else:
+        cos_rad = np.cos(_rad)
+        for k, (vec, rad) in enumerate(zip(xyz, _rad.max(axis=0))):
+            pix = hp.query_disc(NSIDE, vec, rad)
+            cos_dist = np.dot(vec, hp.pix2vec(NSIDE, pix))
+            for i in range(0, len(_rad)):
+                bad[i, pix[cos_dist >= cos_rad[i, k]]] = True
+    if RADrad.ndim == 1:
+        return bad[0]
+    return bad
+
 def mask_src(cat_file, MASK_S_RAD, NSIDE):
-    """Returns the 'bad pixels' defined by the position of a source and a 
-       certain radius away from that point.
+    """Returns the boolean array of the 'bad pixels' defined by the position
+       of a source and a certain radius away from that point.
 
        SOURCE_CAT: str
            opened fits file with the sorce catalog
@@ -37,28 +100,18 @@ def mask_src(cat_file, MASK_S_RAD, NSIDE):
     """
     logger.info('Mask for sources activated')
     src_cat = pf.open(cat_file)
-    NPIX = hp.pixelfunc.nside2npix(NSIDE)
-    CAT = src_cat['LAT_Point_Source_Catalog']
-    BAD_PIX_SRC = []
-    SOURCES = CAT.data
-    RADrad = MASK_S_RAD*np.pi/180.
-    for i in range (0,len(SOURCES)-1):
-        GLON = SOURCES[i][3]
-        GLAT = SOURCES[i][4]
-        x, y, z = hp.rotator.dir2vec(GLON,GLAT,lonlat=True)
-        b_pix= hp.pixelfunc.vec2pix(NSIDE, x, y, z)
-        BAD_PIX_SRC.append(b_pix) 
-    BAD_PIX_inrad = []
-    for bn in BAD_PIX_SRC:
-        pixVec = hp.pix2vec(NSIDE,bn)
-        radintpix = hp.query_disc(NSIDE, pixVec, RADrad)
-        BAD_PIX_inrad.extend(radintpix)  
-    BAD_PIX_SRC.extend(BAD_PIX_inrad)
+    SOURCES = src_cat['LAT_Point_Source_Catalog'].data
+    # the discs are centred on the pixels containing the sources
+    x, y, z = hp.rotator.dir2vec(SOURCES.field(3), SOURCES.field(4),
+                                 lonlat=True)
+    b_pix = hp.pixelfunc.vec2pix(NSIDE, x, y, z)
+    GLON, GLAT = hp.rotator.vec2dir(hp.pix2vec(NSIDE, b_pix), lonlat=True)
     src_cat.close()
-    return BAD_PIX_SRC
+    return mask_discs(GLON, GLAT, np.radians(MASK_S_RAD), NSIDE)
 
 def mask_gp(MASK_GP_LAT,NSIDE):
-    """Returns the 'bad pixels' around the galactic plain .
+    """Returns the boolean array of the 'bad pixels' around the galactic
+       plain.
 
        MASK_GP_LAT: float
            absolute value of galactic latitude definig bad pixels to mask
@@ -66,18 +119,12 @@ def mask_gp(MASK_GP_LAT,NSIDE):
            healpix nside parameter
     """
     logger.info('Mask for the galactic plane activated')
-    NPIX = hp.pixelfunc.nside2npix(NSIDE)
-    BAD_PIX_GP = []
-    iii = range(NPIX)
-    x,y,z = hp.pix2vec(NSIDE,iii)
-    lon,lat = hp.rotator.vec2dir(x,y,z,lonlat=True)
-    for i,b in enumerate(lat):
-        if abs(b) <= MASK_GP_LAT:
-            BAD_PIX_GP.append(iii[i])
-    return BAD_PIX_GP
+    lon, lat = get_pix_lonlat(NSIDE)
+    return np.abs(lat) <= MASK_GP_LAT
 
 def mask_high_lat(MASK_LAT,NSIDE):
-    """Returns the 'bad pixels' at high latitudes from the galactic plain .
+    """Returns the boolean array of the 'bad pixels' at high latitudes from
+       the galactic plain.
 
        MASK_LAT: float
            absolute value of galactic latitude definig bad pixels to mask
@@ -85,113 +132,85 @@ def mask_high_lat(MASK_LAT,NSIDE):
            healpix nside parameter
     """
     logger.info('Mask for high latitudes activated')
-    NPIX = hp.pixelfunc.nside2npix(NSIDE)
-    BAD_PIX_GP = []
-    iii = range(NPIX)
-    x,y,z = hp.pix2vec(NSIDE,iii)
-    lon,lat = hp.rotator.vec2dir(x,y,z,lonlat=True)
-    for i,b in enumerate(lat):
-        if abs(b) >= MASK_LAT:
-            BAD_PIX_GP.append(iii[i])
-    return BAD_PIX_GP
+    lon, lat = get_pix_lonlat(NSIDE)
+    return np.abs(lat) >= MASK_LAT
 
 def mask_hemi_north(NSIDE):
-    """Returns the 'bad pixels' in the northen hemisphere.
+    """Returns the boolean array of the 'bad pixels' in the northen
+       hemisphere.
 
        NSIDE: int
            healpix nside parameter
     """
     logger.info('Masking northen hemisphere...')
-    NPIX = hp.pixelfunc.nside2npix(NSIDE)
-    BAD_PIX_HEMI_N = []
-    iii = range(NPIX)
-    x,y,z = hp.pix2vec(NSIDE,iii)
-    lon,lat = hp.rotator.vec2dir(x,y,z,lonlat=True)
-    for i,b in enumerate(lat):
-        if b >= 0:
-            BAD_PIX_HEMI_N.append(iii[i])
-    return BAD_PIX_HEMI_N
-
+    lon, lat = get_pix_lonlat(NSIDE)
+    return lat >= 0
 
 def mask_hemi_south(NSIDE):
-    """Returns the 'bad pixels' in the southern hemisphere.
+    """Returns the boolean array of the 'bad pixels' in the southern
+       hemisphere.
 
        NSIDE: int
            healpix nside parameter
     """
     logger.info('Masking southern hemisphere...')
-    NPIX = hp.pixelfunc.nside2npix(NSIDE)
-    BAD_PIX_HEMI_S = []
-    iii = range(NPIX)
-    x,y,z = hp.pix2vec(NSIDE,iii)
-    lon,lat = hp.rotator.vec2dir(x,y,z,lonlat=True)
-    for i,b in enumerate(lat):
-        if b <= 0:
-            BAD_PIX_HEMI_S.append(iii[i])
-    return BAD_PIX_HEMI_S
+    lon, lat = get_pix_lonlat(NSIDE)
+    return lat <= 0
 
 def mask_hemi_east(NSIDE):
-    """Returns the 'bad pixels' in the easthern hemisphere.
+    """Returns the boolean array of the 'bad pixels' in the easthern
+       hemisphere.
 
        NSIDE: int
            healpix nside parameter
     """
     logger.info('Masking easthern hemisphere...')
-    NPIX = hp.pixelfunc.nside2npix(NSIDE)
-    BAD_PIX_HEMI_E = []
-    iii = range(NPIX)
-    x,y,z = hp.pix2vec(NSIDE,iii)
-    lon,lat = hp.rotator.vec2dir(x,y,z,lonlat=True)
-    for i,b in enumerate(lon):
-        if -180 <= b <= 0:
-            BAD_PIX_HEMI_E.append(iii[i])
-    return BAD_PIX_HEMI_E
+    lon, lat = get_pix_lonlat(NSIDE)
+    return (lon >= -180)&(lon <= 0)
 
 def mask_hemi_west(NSIDE):
-    """Returns the 'bad pixels' in the westhern hemisphere.
+    """Returns the boolean array of the 'bad pixels' in the westhern
+       hemisphere.
 
        NSIDE: int
            healpix nside parameter
     """
     logger.info('Masking westhern hemisphere...')
-    NPIX = hp.pixelfunc.nside2npix(NSIDE)
-    BAD_PIX_HEMI_W = []
-    iii = range(NPIX)
-    x,y,z = hp.pix2vec(NSIDE,iii)
-    lon,lat = hp.rotator.vec2dir(x,y,z,lonlat=True)
-    for i,b in enumerate(lon):
-        if 0 <= b <= 180:
-            BAD_PIX_HEMI_W.append(iii[i])
-    return BAD_PIX_HEMI_W
+    lon, lat = get_pix_lonlat(NSIDE)
+    return (lon >= 0)&(lon <= 180)
 
 def mask_src_weighted(cat_file, ENERGY, NSIDE):
-    """Returns the 'bad pixels' defined by the position of a source and a 
-       certain radius away from that point. The radii increase with the 
-       brightness.
+    """Returns the boolean array of the 'bad pixels' defined by the position
+       of a source and a certain radius away from that point. The radii
+       increase with the brightness.
 
        SOURCE_CAT: str
            opened fits file with the sorce catalog
+       ENERGY: float or list
+           energy (MeV) setting the normalization of the radii; with a list
+           of energies the (Nenergies, Npix) array of the masks is returned
+           (the catalog is read and each source queried only once)
        NSIDE: int
            healpix nside parameter
     """
     from GRATools.utils.gWindowFunc import get_psf_ref
     psf_ref_file = os.path.join(GRATOOLS_CONFIG, 'ascii/PSF_UCV_PSF1.txt')
     src_cat = pf.open(cat_file)
-    NPIX = hp.pixelfunc.nside2npix(NSIDE)
     CAT = src_cat['LAT_Point_Source_Catalog']
     CAT_EXTENDED = src_cat['ExtendedSources']
-    BAD_PIX_SRC = []
     SOURCES = CAT.data
     EXT_SOURCES = CAT_EXTENDED.data
     src_cat.close()
     psf_ref = get_psf_ref(psf_ref_file)
-    psf_en = psf_ref(ENERGY)
+    psf_en = psf_ref(np.asarray(ENERGY, dtype=float))
     psf_min, psf_max =  psf_ref.y[5], psf_ref.y[-1] 
     norm_min, norm_max = 1, 0.3
     norm = norm_min + psf_en*((norm_max - norm_min)/(psf_max - psf_min)) -\
         psf_min*((norm_max - norm_min)/(psf_max - psf_min))
-    logger.info('Normalization of radii due to energy: %.3f'%norm)
-    print 'Psf(%.2f)= %.2f'%(ENERGY, psf_en)
+    for _en, _psf, _norm in zip(np.atleast_1d(ENERGY), np.atleast_1d(psf_en),
+                                np.atleast_1d(norm)):
+        logger.info('Normalization of radii due to energy: %.3f'%_norm)
+        print 'Psf(%.2f)= %.2f'%(_en, _psf)
     FLUX = SOURCES.field('Flux1000')
     flux_min, flux_max = min(FLUX), max(FLUX)
     rad_min, rad_max = 2., 5.
@@ -212,32 +231,117 @@ def mask_src_weighted(cat_file, ENERGY, NSIDE):
     logger.info('Masking the extended Sources')
     logger.info('-> 10deg around CenA and LMC')
     logger.info('-> 5deg around the remaining')
-    for i, src in enumerate(EXT_SOURCES):
-        NAME = EXT_SOURCES[i][0]
-        GLON = EXT_SOURCES[i][4]
-        GLAT = EXT_SOURCES[i][5]
-        if NAME == 'LMC' or NAME == 'CenA Lobes':
-            x, y, z = hp.rotator.dir2vec(GLON,GLAT,lonlat=True)
-            b_pix= hp.pixelfunc.vec2pix(NSIDE, x, y, z)
-            BAD_PIX_SRC.append(b_pix) 
-            radintpix = hp.query_disc(NSIDE, (x, y, z), np.radians(10)*norm)
-            BAD_PIX_SRC.extend(radintpix)
-        else:
-            x, y, z = hp.rotator.dir2vec(GLON,GLAT,lonlat=True)
-            b_pix = hp.pixelfunc.vec2pix(NSIDE, x, y, z)
-            BAD_PIX_SRC.append(b_pix) 
-            radintpix = hp.query_disc(NSIDE, (x, y, z), np.radians(5)*norm)
-            BAD_PIX_SRC.extend(radintpix)
+    EXT_NAMES = np.char.strip(np.asarray(EXT_SOURCES.field(0), dtype=str))
+    EXT_RADdeg = np.where(np.in1d(EXT_NAMES, ['LMC', 'CenA Lobes']), 10., 5.)
     logger.info('Flux-weighted mask for sources activated')
-    for i, src in enumerate(SOURCES):
-        GLON = SOURCES[i][3]
-        GLAT = SOURCES[i][4]
-        x, y, z = hp.rotator.dir2vec(GLON,GLAT,lonlat=True)
-        b_pix= hp.pixelfunc.vec2pix(NSIDE, x, y, z)
-        BAD_PIX_SRC.append(b_pix) 
-        radintpix = hp.query_disc(NSIDE, (x, y, z), RADrad[i]*norm)
-        BAD_PIX_SRC.extend(radintpix)
-    return BAD_PIX_SRC
+    GLON = np.append(EXT_SOURCES.field(4), SOURCES.field(3))
+    GLAT = np.append(EXT_SOURCES.field(5), SOURCES.field(4))
+    RADrad = np.append(np.radians(EXT_RADdeg), RADrad)
+    if np.ndim(norm) > 0:
+        RADrad = RADrad[np.newaxis]*norm[:, np.newaxis]
+    else:
+        RADrad = RADrad*norm
+    return mask_discs(GLON, GLAT, RADrad, NSIDE)
+
+def mask_distance(mask, max_dist=np.pi):
+    """Returns the angular distance (rad) of each pixel from the nearest
+       masked pixel (0 in the masked pixels, np.inf in the pixels farther
+       than max_dist).
+
+       Only the masked pixels on the edge of the mask (with at least one
+       unmasked neighbour) can be the nearest ones: they are put in a
+       KD-tree, queried with the unmasked pixels, so that the computation
+       scales as Npix*log(Nedge) instead of Npix*Nedge. The KD-tree is
+       first queried with the pixels of a coarse map (with pixels of about
+       max_dist), to query then only the unmasked pixels within the coarse
+       pixels close enough to the edge.
+
+       mask: numpy array
+           healpix map of the mask (0 in the masked pixels)
+       max_dist: float
+           largest distance (rad) to be computed
+    """
+    from scipy.spatial import cKDTree
+    unmasked = np.asarray(mask) != 0
+    npix = len(unmasked)
+    NSIDE = hp.npix2nside(npix)
+    dist = np.zeros(npix)
+    unmask = np.where(unmasked)[0]
+    if len(unmask) == npix:
+        dist[:] = np.inf
+    if len(unmask) == npix or len(unmask) == 0:
+        return dist
+    masked = np.where(np.logical_not(unmasked))[0]
+    edge = []
+    chunk = 2**20
+    for start in range(0, len(masked), chunk):
+        pix = masked[start:start + chunk]
+        neigh = hp.get_all_neighbours(NSIDE, pix)
+        _edge = (unmasked[neigh] & (neigh >= 0)).any(axis=0)
+        edge.append(pix[_edge])
+    edge = np.concatenate(edge)
+    tree = cKDTree(np.array(hp.pix2vec(NSIDE, edge)).T)
+    # the distances are computed along the chord
+    max_chord = lambda d: 2*np.sin(min(d, np.pi)/2.)*(1 + 1e-9)
+    nside_c = NSIDE
+    while nside_c > 1 and hp.max_pixrad(nside_c) < max_dist:
+        nside_c /= 2
+    if nside_c < NSIDE:
+        # coarse pixels with the centre within max_dist + their radius
+        pix_c = np.arange(hp.nside2npix(nside_c))
+        max_dist_c = max_dist + hp.max_pixrad(nside_c)
+        chord, index = tree.query(np.array(hp.pix2vec(nside_c, pix_c)).T,
+                                  distance_upper_bound=max_chord(max_dist_c))
+        near_c = np.isfinite(chord)
+        shift = 2*int(np.log2(NSIDE/nside_c))
+        unmask_c = hp.nest2ring(nside_c, hp.ring2nest(NSIDE, unmask) >> shift)
+        _near = near_c[unmask_c]
+        dist[unmask[np.logical_not(_near)]] = np.inf
+        unmask = unmask[_near]
+    for start in range(0, len(unmask), chunk):
+        pix = unmask[start:start + chunk]
+        chord, index = tree.query(np.array(hp.pix2vec(NSIDE, pix)).T,
+                                  distance_upper_bound=max_chord(max_dist),
+                                  n_jobs=-1)
+        with np.errstate(invalid='ignore'):
+            dist[pix] = 2*np.arcsin(np.minimum(chord/2., 1.))
+        dist[pix[np.isinf(chord)]] = np.inf
+    dist[unmask[dist[unmask] > max_dist]] = np.inf
+    return dist
+
+def apodize_mask(mask, aposize, apotype='C1'):
+    """Returns the apodized mask: the mask is multiplied by a taper going
+       from 0 on the edge of the masked regions to 1 at a distance aposize
+       from them (see mask_distance):
+       - 'C1': x - sin(2*pi*x)/(2*pi), with x = distance/aposize;
+       - 'C2': (1 - cos(pi*x))/2;
+       - 'gaussian': 1 - exp(-x**2/2) (up to 5*aposize, 1 beyond).
+
+       mask: numpy array
+           healpix map of the mask (0 in the masked pixels)
+       aposize: float
+           apodization scale (deg)
+       apotype: str
+           apodization taper ('C1', 'C2' or 'gaussian')
+    """
+    if apotype not in ['C1', 'C2', 'gaussian']:
+        abort('Unknown apodization %s'%apotype)
+    logger.info('Apodizing the mask (%s, %.2f deg)...'%(apotype, aposize))
+    aporad = np.radians(aposize)
+    if apotype == 'gaussian':
+        dist = mask_distance(mask, 5*aporad)
+    else:
+        dist = mask_distance(mask, aporad)
+    taper = np.ones(len(dist))
+    _apo = np.isfinite(dist)
+    x = dist[_apo]/aporad
+    if apotype == 'C1':
+        taper[_apo] = x - np.sin(2*np.pi*x)/(2*np.pi)
+    elif apotype == 'C2':
+        taper[_apo] = 0.5*(1 - np.cos(np.pi*x))
+    else:
+        taper[_apo] = -np.expm1(-0.5*x**2)
+    return np.asarray(mask, dtype=float)*taper
 
 
 def main():
@@ -266,13 +370,10 @@ def main():
     
     nside = 512
     SRC_CATALOG_FILE = os.path.join(FT_DATA_FOLDER,'catalogs/gll_psc_v16.fit')
-    bad_pix = mask_src_weighted(SRC_CATALOG_FILE, 10000, nside)
-    bad_pix += mask_gp(30, nside)
-    npix = hp.nside2npix(nside)
-    mask = np.ones(npix)
-    for bpix in np.unique(bad_pix):
-        mask[bpix] = 0
-    fsky = 1-(len(np.unique(bad_pix))/float(npix))
+    bad = mask_src_weighted(SRC_CATALOG_FILE, 10000, nside)
+    bad |= mask_gp(30, nside)
+    mask = np.logical_not(bad).astype(float)
+    fsky = 1-np.count_nonzero(bad)/float(len(bad))
     title = 'f$_{sky}$ = %.3f'%fsky
     hp.mollview(mask, title=title, coord='G')
     plt.show()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+# On behalf of the Fermi-LAT Collaboration.                                    #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Columnar store of the counts and exposure micro-bin maps and their
+reduction into macro bins
+"""
+
+
+import os
+import json
+import numpy as np
+import healpy as hp
+from GRATools import GRATOOLS_OUT
+from GRATools.utils.logging_ import logger, abort
+from GRATools.utils.gPartialMap import PartialSkyMap
+
+GRATOOLS_OUT_COUNTS = os.path.join(GRATOOLS_OUT, 'output_counts')
+
+
+def get_micro_store_dir(label, nside):
+    """Returns the folder of the micro-bin store of a given data set.
+
+       label: str
+           label of the (time-summed) data set
+       nside: int
+           healpix nside parameter of the stored maps
+    """
+    return os.path.join(GRATOOLS_OUT_COUNTS, '%s_micro_%i'%(label, nside))
+
+def save_micro_index(store):
+    """Writes the JSON index of a micro-bin store (overwriting the file only
+       once the new one is complete).
+    """
+    index_file = os.path.join(store['dir'], 'index.json')
+    f = open(index_file + '_tmp', 'w')
+    json.dump(store['index'], f)
+    f.close()
+    os.rename(index_file + '_tmp', index_file)
+
+def open_micro_store(store_dir, nmicro, nside):
+    """Returns the micro-bin store in store_dir (created if it does not
+       exist) as a dictionary with the 'counts' and 'exposure' arrays of
+       shape (Nmicro, Npix), memory-mapped from the .npy files, and the
+       'index' dictionary (NSIDE, number of micro bins, filled micro bins,
+       their energy edges and the manifest of the labels summed in them)
+       kept in index.json.
+
+       store_dir: str
+           folder of the store (see get_micro_store_dir)
+       nmicro: int
+           total number of micro bins
+       nside: int
+           healpix nside parameter of the stored maps
+    """
+    index_file = os.path.join(store_dir, 'index.json')
+    if not os.path.exists(index_file):
+        logger.info('Creating the micro-bin store %s...'%store_dir)
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        npix = hp.nside2npix(nside)
+        # the exposure is accumulated over many ingestions: double precision
+        for name, dtype in [('counts', np.float32), ('exposure', np.float64)]:
+            arr = np.lib.format.open_memmap(os.path.join(store_dir,
+                                                         '%s.npy'%name),
+                                            mode='w+', dtype=dtype,
+                                            shape=(nmicro, npix))
+            del arr
+        index = {'nside': nside, 'nmicro': nmicro,
+                 'filled': [False]*nmicro,
+                 'emin': [None]*nmicro, 'emax': [None]*nmicro,
+                 'labels': {}}
+        save_micro_index({'dir': store_dir, 'index': index})
+    f = open(index_file, 'r')
+    index = json.load(f)
+    f.close()
+    if 'labels' not in index:
+        index['labels'] = {}
+    if index['nside'] != nside or index['nmicro'] != nmicro:
+        abort('Micro-bin store %s has NSIDE=%i and %i micro bins'\
+                  %(store_dir, index['nside'], index['nmicro']))
+    store = {'dir': store_dir, 'index': index}
+    for name in ['counts', 'exposure']:
+        store[name] = np.load(os.path.join(store_dir, '%s.npy'%name),
+                              mmap_mode='r+')
+    return store
+
+def micro_bins_filled(store, minb, maxb):
+    """Returns True if the micro bins from minb to maxb (included) are all
+       in the store.
+    """
+    return all(store['index']['filled'][minb:maxb+1])
+
+def write_micro_bins(store, minb, counts, exposure, emin, emax):
+    """Writes the (N, Npix) counts and exposure arrays of the micro bins
+       from minb to minb+N-1, with their energy edges, in the store.
+    """
+    maxb = minb + len(counts)
+    store['counts'][minb:maxb] = counts
+    store['exposure'][minb:maxb] = exposure
+    store['counts'].flush()
+    store['exposure'].flush()
+    for k, mb in enumerate(range(minb, maxb)):
+        store['index']['filled'][mb] = True
+        store['index']['emin'][mb] = float(emin[k])
+        store['index']['emax'][mb] = float(emax[k])
+    save_micro_index(store)
+
+def add_micro_bins(store, minb, counts, exposure):
+    """Adds the (N, Npix) counts and exposure arrays to the micro bins from
+       minb to minb+N-1 of the store (which must be already filled).
+    """
+    maxb = minb + len(counts)
+    if not micro_bins_filled(store, minb, maxb-1):
+        abort('Micro bins %i-%i not in %s'%(minb, maxb-1, store['dir']))
+    store['counts'][minb:maxb] += counts
+    store['exposure'][minb:maxb] += exposure
+    store['counts'].flush()
+    store['exposure'].flush()
+
+def get_micro_runs(micro_bins):
+    """Returns the list of the (first, last) micro bins of the runs of
+       consecutive micro bins in the given list.
+    """
+    micro_bins = np.unique(micro_bins)
+    if len(micro_bins) == 0:
+        return []
+    breaks = np.where(np.diff(micro_bins) > 1)[0]
+    first = np.append(micro_bins[0], micro_bins[breaks + 1])
+    last = np.append(micro_bins[breaks], micro_bins[-1])
+    return zip(first, last)
+
+def read_micro_bins(store, minb, maxb):
+    """Returns the (N, Npix) counts and exposure arrays and the energy edges
+       of the micro bins from minb to maxb (included), with a single slice
+       read of the store.
+    """
+    if not micro_bins_filled(store, minb, maxb):
+        abort('Micro bins %i-%i not in %s'%(minb, maxb, store['dir']))
+    counts = np.array(store['counts'][minb:maxb+1], dtype=np.float64)
+    exposure = np.array(store['exposure'][minb:maxb+1], dtype=np.float64)
+    emin = np.array(store['index']['emin'][minb:maxb+1])
+    emax = np.array(store['index']['emax'][minb:maxb+1])
+    return counts, exposure, emin, emax
+
+def reduce_micro_bins(counts, exposure, emean, gamma, unmask, pix=None):
+    """Returns the flux and flux error maps (PartialSkyMap) and the counts
+       map of a macro bin and its white noise (CN) term, from the stacked
+       (Nmicro, Npix) counts and exposure arrays of its micro bins.
+
+       The flux and its error are computed only in the given pixels, with a
+       few operations over the whole (Nmicro, Npix) sub-array instead of a
+       loop over the micro bins.
+
+       emean: numpy array
+           mean energy of the micro bins
+       gamma: float
+           spectral index used to weight the exposure of the micro bins
+           in the flux error
+       unmask: numpy array
+           unmasked pixels (used for CN)
+       pix: numpy array
+           pixels in which the maps are computed (default: unmask)
+    """
+    if pix is None:
+        pix = unmask
+    npix = counts.shape[1]
+    sr = 4*np.pi/npix
+    _counts = counts[:, pix]
+    inv_exp = 1./exposure[:, pix]
+    nside = hp.npix2nside(npix)
+    flux = PartialSkyMap(nside, pix, np.einsum('ij,ij->j', _counts,
+                                               inv_exp)/sr)
+    np.square(inv_exp, out=inv_exp)
+    w = (np.asarray(emean)/emean[0])**(-gamma)
+    fluxerr = PartialSkyMap(nside, pix,
+                            np.sqrt(_counts[0]*np.dot(w, inv_exp))/sr)
+    cn_map = np.einsum('ij,ij->j', _counts, inv_exp)
+    CN = np.mean(cn_map[np.in1d(pix, unmask)])/sr
+    macro_counts = np.sum(counts, axis=0)
+    return flux, fluxerr, macro_counts, CN
+
+
+def main():
+    """Test module
+    """
+    store = open_micro_store(get_micro_store_dir('test', 4), 10, 4)
+    npix = hp.nside2npix(4)
+    write_micro_bins(store, 2, np.ones((3, npix)), 2*np.ones((3, npix)),
+                     [1., 2., 3.], [2., 3., 4.])
+    print(micro_bins_filled(store, 2, 4), micro_bins_filled(store, 2, 5))
+    print(read_micro_bins(store, 3, 4)[2:])
+
+
+if __name__ == '__main__':
+    main()
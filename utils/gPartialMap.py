@@ -0,0 +1,213 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+# On behalf of the Fermi-LAT Collaboration.                                    #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Partial-sky healpix maps
+"""
+
+
+import numpy as np
+import healpy as hp
+import pyfits as pf
+from GRATools.utils.logging_ import logger, abort
+
+
+class PartialSkyMap(object):
+
+    """Healpix map defined only in a subset of the pixels (typically the
+    unmasked ones): the indices of the pixels are stored once, together
+    with the compact array of the values.
+    Arithmetic operations (+, -, *, /, **) are supported with numbers,
+    with compact arrays and with other PartialSkyMap objects defined in the
+    same pixels.
+    Args
+    ----
+    nside : int
+        Healpix nside parameter.
+    pix : array
+        Indices of the pixels (RING scheme, sorted).
+    values : array
+        Values of the map in the pixels.
+    """
+
+    # numpy arrays defer the arithmetic operations to the partial map
+    __array_priority__ = 20
+
+    def __init__(self, nside, pix, values):
+        """Constructor.
+        """
+        self.nside = nside
+        self.pix = np.asarray(pix, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64)
+        if len(self.pix) != len(self.values):
+            abort('PartialSkyMap: %i pixels and %i values'\
+                      %(len(self.pix), len(self.values)))
+
+    @classmethod
+    def from_map(cls, full_map, pix=None):
+        """Returns the partial-sky map of a full-sky map in the given pixels
+        (by default, the pixels which are not hp.UNSEEN).
+        """
+        full_map = np.asarray(full_map)
+        if pix is None:
+            pix = np.where(full_map != hp.UNSEEN)[0]
+        return cls(hp.npix2nside(len(full_map)), pix, full_map[pix])
+
+    @classmethod
+    def from_ma(cls, masked_map):
+        """Returns the partial-sky map of the unmasked pixels of a masked
+        map (as returned by hp.ma).
+        """
+        pix = np.where(np.logical_not(np.ma.getmaskarray(masked_map)))[0]
+        return cls.from_map(np.ma.getdata(masked_map), pix)
+
+    @classmethod
+    def read(cls, fits_file, field=0):
+        """Reads a map from a fits file, either in the partial-sky (explicit
+        indexing) or in the full-sky format; in the latter case only the
+        pixels which are not hp.UNSEEN are kept.
+        """
+        hdu = pf.open(fits_file)
+        header = hdu[1].header
+        if header.get('INDXSCHM', 'IMPLICIT').strip() == 'EXPLICIT':
+            nside = header['NSIDE']
+            pix = np.asarray(hdu[1].data.field(0), dtype=np.int64)
+            values = np.asarray(hdu[1].data.field(field + 1),
+                                dtype=np.float64)
+            if header.get('ORDERING', 'RING').strip() == 'NESTED':
+                pix = hp.nest2ring(nside, pix)
+            hdu.close()
+            order = np.argsort(pix)
+            return cls(nside, pix[order], values[order])
+        hdu.close()
+        return cls.from_map(hp.read_map(fits_file, field=field))
+
+    def __len__(self):
+        """Returns the number of pixels.
+        """
+        return len(self.pix)
+
+    def npix(self):
+        """Returns the number of pixels of the full-sky map.
+        """
+        return hp.nside2npix(self.nside)
+
+    def fsky(self):
+        """Returns the fraction of the sky covered by the map.
+        """
+        return len(self.pix)/float(self.npix())
+
+    def sum(self):
+        """Returns the sum of the values.
+        """
+        return np.sum(self.values)
+
+    def mean(self):
+        """Returns the mean of the values.
+        """
+        return np.mean(self.values)
+
+    def to_map(self, fill=hp.UNSEEN):
+        """Returns the full-sky map (fill value outside the pixels).
+        """
+        full_map = np.full(self.npix(), fill, dtype=np.float64)
+        full_map[self.pix] = self.values
+        return full_map
+
+    def to_ma(self):
+        """Returns the full-sky masked map (as returned by hp.ma).
+        """
+        masked_map = hp.ma(self.to_map())
+        masked_map.mask = np.ones(self.npix(), dtype=bool)
+        masked_map.mask[self.pix] = False
+        return masked_map
+
+    def restrict(self, pix):
+        """Returns the partial-sky map in the pixels which are both in the
+        map and in the given ones.
+        """
+        _pix = np.intersect1d(self.pix, pix)
+        index = np.searchsorted(self.pix, _pix)
+        return PartialSkyMap(self.nside, _pix, self.values[index])
+
+    def write(self, fits_file, coord='G', partial=True, overwrite=False):
+        """Writes the map in a fits file, in the partial-sky format (explicit
+        indexing of the pixels) or in the full-sky one (an existing file is
+        replaced only if overwrite).
+        """
+        hp.write_map(fits_file, self.to_map(), coord=coord, partial=partial,
+                     overwrite=overwrite)
+
+    def _compact(self, other):
+        """Returns the compact values of the other operand of an arithmetic
+        operation.
+        """
+        if isinstance(other, PartialSkyMap):
+            if other.pix is not self.pix and \
+                    not np.array_equal(other.pix, self.pix):
+                abort('PartialSkyMap: operation between different pixels')
+            return other.values
+        return other
+
+    def __add__(self, other):
+        return PartialSkyMap(self.nside, self.pix,
+                             self.values + self._compact(other))
+
+    def __sub__(self, other):
+        return PartialSkyMap(self.nside, self.pix,
+                             self.values - self._compact(other))
+
+    def __mul__(self, other):
+        return PartialSkyMap(self.nside, self.pix,
+                             self.values*self._compact(other))
+
+    def __div__(self, other):
+        return PartialSkyMap(self.nside, self.pix,
+                             self.values/self._compact(other))
+
+    def __pow__(self, other):
+        return PartialSkyMap(self.nside, self.pix,
+                             self.values**self._compact(other))
+
+    def __radd__(self, other):
+        return self.__add__(other)
+
+    def __rsub__(self, other):
+        return PartialSkyMap(self.nside, self.pix,
+                             self._compact(other) - self.values)
+
+    def __rmul__(self, other):
+        return self.__mul__(other)
+
+    def __rdiv__(self, other):
+        return PartialSkyMap(self.nside, self.pix,
+                             self._compact(other)/self.values)
+
+    __truediv__ = __div__
+    __rtruediv__ = __rdiv__
+
+
+def main():
+    """Test module
+    """
+    nside = 16
+    full_map = np.arange(hp.nside2npix(nside), dtype=float)
+    full_map[:1000] = hp.UNSEEN
+    m = PartialSkyMap.from_map(full_map)
+    print(len(m), m.fsky(), m.mean())
+    m2 = 2*m + 1
+    print(np.allclose(m2.to_map()[1000:], 2*full_map[1000:] + 1))
+    print(m2.restrict(np.arange(990, 1010)).pix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python                                                          #
+#                                                                              #
+# Autor: Michela Negro, University of Torino.                                  #
+# On behalf of the Fermi-LAT Collaboration.                                    #
+#                                                                              #
+# This program is free software; you can redistribute it and/or modify         #
+# it under the terms of the GNU GengReral Public License as published by       #
+# the Free Software Foundation; either version 3 of the License, or            #
+# (at your option) any later version.                                          #
+#                                                                              #
+#------------------------------------------------------------------------------#
+
+
+"""Reprojection of Cartesian (CAR) maps onto healpix maps
+"""
+
+
+import os
+import hashlib
+import numpy as np
+import healpy as hp
+from scipy import sparse
+from GRATools.utils.logging_ import logger, abort
+
+
+def car_grid_index(lon_grid, lat_grid, lon, lat):
+    """Returns, for each of the given (lon, lat) points, the (4, N) arrays
+       of the indices (in the flattened (Nlat, Nlon) CAR map) and of the
+       weights of the bilinear interpolation between the 4 nearest nodes
+       of the grid.
+
+       The longitude is periodic; outside the latitude range the values
+       at the edge of the grid are used.
+
+       lon_grid: numpy array
+           longitude (deg) of each column of the CAR map, evenly spaced
+           modulo 360 (in any order, e.g. starting from 180)
+       lat_grid: numpy array
+           latitude (deg) of each row of the CAR map, evenly spaced and
+           increasing
+    """
+    nlon, nlat = len(lon_grid), len(lat_grid)
+    order = np.argsort(np.mod(lon_grid, 360.))
+    lon0 = np.mod(lon_grid, 360.)[order[0]]
+    dlon = 360./nlon
+    dlat = (lat_grid[-1] - lat_grid[0])/(nlat - 1)
+    fx = np.mod(lon - lon0, 360.)/dlon
+    i0 = np.floor(fx).astype(np.int64)
+    tx = fx - i0
+    i0 = np.mod(i0, nlon)
+    i1 = np.mod(i0 + 1, nlon)
+    fy = np.clip((lat - lat_grid[0])/dlat, 0, nlat - 1)
+    j0 = np.minimum(np.floor(fy).astype(np.int64), nlat - 2)
+    ty = fy - j0
+    col0, col1 = order[i0], order[i1]
+    index = np.array([j0*nlon + col0, j0*nlon + col1,
+                      (j0 + 1)*nlon + col0, (j0 + 1)*nlon + col1])
+    weights = np.array([(1 - tx)*(1 - ty), tx*(1 - ty),
+                        (1 - tx)*ty, tx*ty])
+    return index, weights
+
+def car2healpix_operator(lon_grid, lat_grid, nside):
+    """Returns the sparse (Npix, Nlat*Nlon) matrix of the bilinear
+       interpolation of a CAR map (flattened) at the centres of the healpix
+       pixels (see car_grid_index), so that each plane of a cube is
+       reprojected with a sparse-dense product.
+
+       nside: int
+           healpix nside parameter of the output maps
+    """
+    npix = hp.nside2npix(nside)
+    logger.info('Building the CAR -> healpix (NSIDE=%i) operator...'%nside)
+    # 4 entries per row, filled by chunks of pixels to limit the memory
+    indices = np.zeros(4*npix, dtype=np.int32)
+    data = np.zeros(4*npix)
+    chunk = 2**20
+    for start in range(0, npix, chunk):
+        stop = min(start + chunk, npix)
+        lon, lat = hp.pix2ang(nside, np.arange(start, stop), lonlat=True)
+        index, weights = car_grid_index(lon_grid, lat_grid, lon, lat)
+        indices[4*start:4*stop] = index.T.ravel()
+        data[4*start:4*stop] = weights.T.ravel()
+    indptr = np.arange(0, 4*npix + 1, 4, dtype=np.int64)
+    return sparse.csr_matrix((data, indices, indptr),
+                             shape=(npix, len(lon_grid)*len(lat_grid)))
+
+def car_cell_index(lon_grid, lat_grid, lon, lat):
+    """Returns the index (in the flattened (Nlat, Nlon) CAR map) of the cell
+       containing each of the given (lon, lat) points, i.e. of the nearest
+       node of the grid (see car_grid_index for the grid arguments).
+    """
+    index, weights = car_grid_index(lon_grid, lat_grid, lon, lat)
+    return index[np.argmax(weights, axis=0), np.arange(len(lon))]
+
+def car2healpix_area_operator(lon_grid, lat_grid, nside, nsub=4):
+    """Returns the sparse (Npix, Nlat*Nlon) matrix averaging a CAR map
+       (flattened) over the area of each healpix pixel: each pixel is split
+       into its nsub**2 sub-pixels at NSIDE nside*nsub and the weight of a
+       CAR cell is the fraction of them falling into it, so that the
+       integral of the map over the sky is conserved.
+
+       nside: int
+           healpix nside parameter of the output maps
+       nsub: int
+           number of sub-pixels along each side of a pixel (power of 2)
+    """
+    npix = hp.nside2npix(nside)
+    nsub2 = nsub**2
+    logger.info('Building the CAR -> healpix (NSIDE=%i, %i sub-pixels) '\
+                    'area operator...'%(nside, nsub2))
+    rows, cols, data = [], [], []
+    chunk = max(2**22/nsub2, 1)
+    for start in range(0, npix, chunk):
+        pix = np.arange(start, min(start + chunk, npix))
+        # NESTED children of each pixel at NSIDE nside*nsub
+        sub = (hp.ring2nest(nside, pix)*nsub2)[:, np.newaxis] + \
+            np.arange(nsub2)
+        lon, lat = hp.pix2ang(nside*nsub, sub.ravel(), nest=True,
+                              lonlat=True)
+        cell = car_cell_index(lon_grid, lat_grid, lon, lat)
+        # each (pixel, cell) pair once, with the number of its sub-pixels
+        key = np.repeat(pix, nsub2)*(len(lon_grid)*len(lat_grid)) + cell
+        key, counts = np.unique(key, return_counts=True)
+        rows.append(key//(len(lon_grid)*len(lat_grid)))
+        cols.append(key%(len(lon_grid)*len(lat_grid)))
+        data.append(counts/float(nsub2))
+    return sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows),
+                                                     np.concatenate(cols))),
+                             shape=(npix, len(lon_grid)*len(lat_grid)))
+
+def get_operator_file(cache_dir, lon_grid, lat_grid, nside, nsub):
+    """Returns the .npz file in cache_dir of the area operator of a given
+       grid at a given NSIDE (the grid is identified by the hash of the
+       longitudes and latitudes of its nodes).
+    """
+    grid_hash = hashlib.md5(np.asarray(lon_grid, dtype=np.float64).tostring()\
+                                + np.asarray(lat_grid,
+                                             dtype=np.float64).tostring())
+    return os.path.join(cache_dir, 'car%ix%i_%s_hp%i_sub%i.npz'\
+                            %(len(lon_grid), len(lat_grid),
+                              grid_hash.hexdigest()[:12], nside, nsub))
+
+def get_area_operator(cache_dir, lon_grid, lat_grid, nside, nsub=4):
+    """Returns the area operator (see car2healpix_area_operator), read from
+       cache_dir if it was already computed for the same grid and NSIDE,
+       otherwise computed and saved there.
+    """
+    operator_file = get_operator_file(cache_dir, lon_grid, lat_grid, nside,
+                                      nsub)
+    if os.path.exists(operator_file):
+        logger.info('Using the reprojection operator %s'%operator_file)
+        return sparse.load_npz(operator_file)
+    operator = car2healpix_area_operator(lon_grid, lat_grid, nside, nsub)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # the file name must end with .npz, otherwise save_npz appends it
+    tmp_file = operator_file.replace('.npz', '_tmp.npz')
+    sparse.save_npz(tmp_file, operator)
+    os.rename(tmp_file, operator_file)
+    logger.info('Created %s'%operator_file)
+    return operator
+
+def reproject_planes(operator, planes):
+    """Returns the (Nplanes, Npix) array of the healpix maps of the given
+       (Nplanes, Nlat, Nlon) CAR planes, with a single sparse-dense product.
+    """
+    planes = np.asarray(planes, dtype=np.float64)
+    if planes.shape[1]*planes.shape[2] != operator.shape[1]:
+        abort('CAR planes do not match the reprojection operator')
+    flat = planes.reshape(len(planes), -1).T
+    return np.asarray(operator.dot(flat)).T
+
+
+def main():
+    """Test module
+    """
+    lon_grid = np.append(np.arange(180., 360., 10.), np.arange(0., 180., 10.))
+    lat_grid = np.arange(-90., 90.1, 10.)
+    lon, lat = np.meshgrid(lon_grid, lat_grid)
+    planes = np.array([lat, np.cos(np.radians(lon))])
+    op = car2healpix_operator(lon_grid, lat_grid, 8)
+    maps = reproject_planes(op, planes)
+    _lon, _lat = hp.pix2ang(8, np.arange(hp.nside2npix(8)), lonlat=True)
+    print(np.max(np.abs(maps[0] - _lat)))
+
+
+if __name__ == '__main__':
+    main()